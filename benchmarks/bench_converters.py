@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the document conversion throughput of the LibreOffice converter pool.
+
+Converts every document of --source to PDF with pools of each of the --sizes,
+and reports the start-up time of the pool and the documents converted per
+second. Needs unoconv and LibreOffice (see examples/README.md).
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'examples'))
+
+from generic import ConverterPool  # noqa: E402
+
+
+def convert_all(pool, documents, dst):
+    with concurrent.futures.ThreadPoolExecutor(pool.size) as executor:
+        jobs = [executor.submit(pool.convert, path, os.path.join(dst, '{}.pdf'.format(i)))
+                for i, path in enumerate(documents)]
+        return sum(job.result() for job in jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--source', required=True, help='Directory of documents to convert')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+    documents = sorted(os.path.join(args.source, name) for name in os.listdir(args.source)
+                       if os.path.isfile(os.path.join(args.source, name)))
+    dst = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            start = time.perf_counter()
+            pool = ConverterPool(size)
+            ready = time.perf_counter() - start
+            try:
+                start = time.perf_counter()
+                converted = convert_all(pool, documents, dst)
+                elapsed = time.perf_counter() - start
+            finally:
+                pool.close()
+            print('{:>2} listeners: ready in {:.1f}s, {}/{} documents in {:.1f}s ({:.2f} documents/s)'.format(
+                size, ready, converted, len(documents), elapsed, len(documents) / elapsed))
+    finally:
+        shutil.rmtree(dst)
+
+
+if __name__ == '__main__':
+    main()
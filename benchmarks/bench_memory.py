@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the memory held per file when keeping the results of a run.
+
+Checks --count small files and keeps the File objects, then the FileResult
+records they can be reduced to, and reports the memory used per file.
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bin.filecheck import File  # noqa: E402
+
+
+class NullLogger(object):
+    log_debug_err = os.devnull
+    log_debug_out = os.devnull
+
+    def add_file(self, file_path, file_props):
+        pass
+
+
+def make_source(path, count):
+    os.makedirs(path)
+    samples = ('txt', 'conf', 'exe', 'dat', 'csv')
+    for i in range(count):
+        extension = samples[i % len(samples)]
+        with open(os.path.join(path, 'file{}.{}'.format(i, extension)), 'w') as f:
+            f.write('sample {}\n'.format(i))
+
+
+def check_files(src, dst):
+    files = []
+    logger = NullLogger()
+    for filename in sorted(os.listdir(src)):
+        file = File(os.path.join(src, filename), os.path.join(dst, filename), logger)
+        file.check()
+        file.write_log()
+        files.append(file)
+    return files
+
+
+def measure(function, *args):
+    """Return the result of function(*args) and the memory it still holds."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = function(*args)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=5000)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    src = os.path.join(workdir, 'src')
+    make_source(src, args.count)
+    try:
+        files, held = measure(check_files, src, os.path.join(workdir, 'dst'))
+        print('{:>11}: {:.0f} bytes/file'.format('File', held / args.count))
+        if hasattr(files[0], 'result'):
+            results, held = measure(lambda: [file.result() for file in files])
+            print('{:>11}: {:.0f} bytes/file'.format('FileResult', held / args.count))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the PDF/A normalization of big PDFs by examples/generic.py.
+
+Converts a --pages pages PDF (generated with Ghostscript unless --source is
+given) in one Ghostscript run, then split in page ranges of each of the
+--split sizes converted in parallel. --resources is the directory holding
+PDFA_def.ps and its ICC profile. Needs Ghostscript and qpdf.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'examples'))
+
+import generic  # noqa: E402
+
+PAGE = b"""
+/Helvetica findfont 10 scalefont setfont
+0 1 70 {{ /line exch def 40 760 line 10 mul sub moveto
+  (Page {0}, line ) show line 10 string cvs show
+  ( - the quick brown fox jumps over the lazy dog) show }} for
+0.5 setgray 100 100 400 200 rectfill 0 setgray
+showpage
+"""
+
+
+def make_pdf(path, pages):
+    ps_path = path + '.ps'
+    with open(ps_path, 'wb') as f:
+        for page in range(1, pages + 1):
+            f.write(PAGE.replace(b'{0}', str(page).encode()).replace(b'{{', b'{').replace(b'}}', b'}'))
+    subprocess.check_call([generic.GS, '-q', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-sDEVICE=pdfwrite',
+                           '-sOutputFile=' + path, ps_path])
+    os.remove(ps_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--resources', required=True, help='Directory of PDFA_def.ps')
+    parser.add_argument('-s', '--source', help='PDF to convert')
+    parser.add_argument('--pages', type=int, default=400)
+    parser.add_argument('--split', type=int, nargs='+', default=[50, 100])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if not os.path.exists(generic.QPDF):
+        parser.error('{} is needed to merge the page ranges'.format(generic.QPDF))
+    workdir = tempfile.mkdtemp()
+    try:
+        source = args.source
+        if source is None:
+            source = os.path.join(workdir, 'source.pdf')
+            make_pdf(source, args.pages)
+        for split_pages in [0] + args.split:
+            converter = generic.PdfaConverter(args.resources, split_pages, args.workers)
+            try:
+                start = time.perf_counter()
+                ok = converter.convert(source, os.path.join(workdir, 'out.pdf'))
+                elapsed = time.perf_counter() - start
+            finally:
+                converter.close()
+            name = 'whole document' if not split_pages else 'ranges of {} pages'.format(split_pages)
+            print('{:>19}: {:.1f}s{}'.format(name, elapsed, '' if ok else ' (failed)'))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare synchronous copies with the write-behind DestinationWriter.
+
+Point --destination at the slow medium you care about (e.g. a mounted USB
+key), the numbers on a local SSD are not very meaningful.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from kittengroomer import FileBase, DestinationWriter
+
+
+def make_source(path, count, size):
+    os.makedirs(path)
+    payload = os.urandom(size)
+    for i in range(count):
+        subdir = os.path.join(path, 'dir{}'.format(i % 20))
+        os.makedirs(subdir, exist_ok=True)
+        with open(os.path.join(subdir, 'file{}.txt'.format(i)), 'wb') as f:
+            f.write(payload)
+
+
+def groom(src_root, dst_root, writer):
+    start = time.perf_counter()
+    for root, dirs, files in os.walk(src_root):
+        for filename in files:
+            src = os.path.join(root, filename)
+            dst = os.path.join(dst_root, os.path.relpath(src, src_root))
+            FileBase(src, dst, writer).safe_copy()
+    if writer is not None:
+        writer.close()
+    else:
+        os.sync()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--destination', default=tempfile.gettempdir())
+    parser.add_argument('-n', '--count', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=4096)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    src = os.path.join(workdir, 'src')
+    make_source(src, args.count, args.size)
+    try:
+        for name, writer in (('synchronous', None), ('write-behind', DestinationWriter())):
+            dst = os.path.join(args.destination, 'bench_writer_dst')
+            shutil.rmtree(dst, ignore_errors=True)
+            elapsed = groom(src, dst, writer)
+            print('{:>13}: {:.3f}s ({:.0f} files/s)'.format(name, elapsed, args.count / elapsed))
+            shutil.rmtree(dst, ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,49 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import sys
 import mimetypes
 import shlex
 import subprocess
 import zipfile
 import argparse
 import shutil
-
-import oletools.oleid
-import olefile
-import officedissector
+import json
+import time
+import socket
+import select
+import queue
+import traceback
 import warnings
-import exifread
-from PIL import Image
+import importlib
+import threading
+import tempfile
+import concurrent.futures
+import array
+import heapq
+import itertools
+import functools
+import collections
+import unicodedata
+import io
+import copy
+
+import magic
+# The analysis dependencies (oletools, olefile, officedissector, exifread,
+# PIL and pdfid) are slow to import, so they are imported by the handlers
+# that use them. warm_up() imports all of them ahead of time.
 # TODO: why do we have this import? How does filecheck handle pngs?
 # from PIL import PngImagePlugin
-from pdfid import PDFiD, cPDFiD
 
-from kittengroomer import FileBase, KittenGroomerBase, Logging
+from kittengroomer import FileBase, KittenGroomerBase, DestinationWriter, ArchiveWriter, Logging
+from kittengroomer import ProgressTracker, print_progress, KittenGroomerError
 
 
 SEVENZ_PATH = '/usr/bin/7z'
 
+ANALYSIS_MODULES = ('oletools.oleid', 'olefile', 'officedissector', 'exifread',
+                    'PIL.Image', 'pdfid')
+
 
 class Config:
     """Configuration information for Filecheck."""
@@ -84,52 +105,122 @@ class Config:
     # It works as expected if you do mimetypes.guess_type('application/gzip', strict=False)
     override_ext = {'.gz': 'application/gzip'}
 
+    # Reverses the display of what follows it, to disguise extensions
+    right_to_left_override = '\u202e'
+    # Bidirectional formatting characters, which change how names are displayed
+    bidi_controls = '\u061c\u200e\u200f\u202a\u202b\u202c\u202d\u202e\u2066\u2067\u2068\u2069'
+
+
+def _escape_name(name):
+    """Return `name` with its control and bidi characters escaped, to print it safely."""
+    return ''.join('\\u{:04x}'.format(ord(c)) if c in Config.bidi_controls or unicodedata.category(c) == 'Cc'
+                   else c for c in name)
+
+
+def _make_method_dict(list_of_tuples):
+    """Returns a dictionary with mimetype: method pairs."""
+    dict_to_return = {}
+    for list_of_subtypes, method in list_of_tuples:
+        for subtype in list_of_subtypes:
+            dict_to_return[subtype] = method
+    return dict_to_return
+
+
+class _DiscardedOutput(object):
+    """Writer and scratch space of a file whose checks were given up on: drops its outputs."""
+
+    def copy(self, src, dst, on_error=None):
+        pass
+
+    def write(self, path, data, on_error=None):
+        pass
+
+    def duplicate(self, src, dst, on_error=None):
+        pass
+
+    def makedirs(self, path):
+        pass
+
+    def make_dir(self, name, size, fallback_path):
+        raise KittenGroomerError('The checks of {} were given up on'.format(name))
+
+    def release(self, path):
+        pass
+
 
 class File(FileBase):
 
-    def __init__(self, src_path, dst_path, logger):
-        super(File, self).__init__(src_path, dst_path)
+    __slots__ = ('is_recursive', 'content_checked', 'full_diagnostics', 'logger',
+                 'scratch', 'tempdir_path', 'src_copy_dir', 'profiler')
+
+    # The handlers are looked up by name, so these are shared by all files
+    app_subtype_methods = _make_method_dict([
+        (Config.mimes_office, '_winoffice'),
+        (Config.mimes_ooxml, '_ooxml'),
+        (Config.mimes_rtf, 'text'),
+        (Config.mimes_libreoffice, '_libreoffice'),
+        (Config.mimes_pdf, '_pdf'),
+        (Config.mimes_xml, 'text'),
+        (Config.mimes_ms, '_executables'),
+        (Config.mimes_compressed, '_archive'),
+        (Config.mimes_data, '_binary_app'),
+    ])
+
+    metadata_mimetype_methods = _make_method_dict([
+        (Config.mimes_exif, '_metadata_exif'),
+        (Config.mimes_png, '_metadata_png'),
+    ])
+
+    mime_processing_options = {
+        'text': 'text',
+        'audio': 'audio',
+        'image': 'image',
+        'video': 'video',
+        'application': 'application',
+        'example': 'example',
+        'message': 'message',
+        'model': 'model',
+        'multipart': 'multipart',
+        'inode': 'inode',
+    }
+
+    def __init__(self, src_path, dst_path, logger, writer=None, full_diagnostics=False,
+                 scratch=None, src_data=None, profiler=None):
+        super(File, self).__init__(src_path, dst_path, writer, src_data)
         self.is_recursive = False
+        self.content_checked = False  # True once the mimetype handler has run
+        # Run every check even when the file is already known to be dangerous
+        self.full_diagnostics = full_diagnostics
         self.logger = logger
-        self.tempdir_path = self.dst_path + '_temp'
-
-        subtypes_apps = [
-            (Config.mimes_office, self._winoffice),
-            (Config.mimes_ooxml, self._ooxml),
-            (Config.mimes_rtf, self.text),
-            (Config.mimes_libreoffice, self._libreoffice),
-            (Config.mimes_pdf, self._pdf),
-            (Config.mimes_xml, self.text),
-            (Config.mimes_ms, self._executables),
-            (Config.mimes_compressed, self._archive),
-            (Config.mimes_data, self._binary_app),
-        ]
-        self.app_subtype_methods = self._make_method_dict(subtypes_apps)
-
-        types_metadata = [
-            (Config.mimes_exif, self._metadata_exif),
-            (Config.mimes_png, self._metadata_png),
-        ]
-        self.metadata_mimetype_methods = self._make_method_dict(types_metadata)
-
-        self.mime_processing_options = {
-            'text': self.text,
-            'audio': self.audio,
-            'image': self.image,
-            'video': self.video,
-            'application': self.application,
-            'example': self.example,
-            'message': self.message,
-            'model': self.model,
-            'multipart': self.multipart,
-            'inode': self.inode,
-        }
+        # Intermediate files go to the ScratchSpace if there is one
+        self.scratch = scratch
+        self.tempdir_path = None
+        self.src_copy_dir = None  # Holds the copy of an in-memory source on disk
+        self.profiler = profiler  # FileProfiler the checks are run through, if any
+
+    # The checks run by check(), in increasing order of cost. Once a file
+    # is dangerous its verdict can't change, so what happens next depends
+    # on the last field: 'always' checks still run (they do more than
+    # refine the verdict), 'diagnostics' checks only run to collect every
+    # reason when full_diagnostics is set, and 'never' checks are skipped.
+    # (method name, cost, runs on dangerous files)
+    checks = (
+        ('_check_filename', 1, 'always'),
+        ('_check_dangerous', 1, 'diagnostics'),
+        ('_check_extension', 2, 'diagnostics'),
+        ('_check_mimetype', 2, 'diagnostics'),
+        ('_check_contents', 100, 'never'),
+    )
 
     def _check_dangerous(self):
         if not self.has_mimetype:
             self.make_dangerous('File has no mimetype')
+            if self.verdict_is_final:
+                return
         if not self.has_extension:
             self.make_dangerous('File has no extension')
+            if self.verdict_is_final:
+                return
         if self.extension in Config.malicious_exts:
             self.make_dangerous('Extension identifies file as potentially dangerous')
 
@@ -142,14 +233,12 @@ class File(FileBase):
         mimetype based on its extension differs from the mimetype determined
         by libmagic, then mark the file as dangerous.
         """
-        if self.extension in Config.override_ext:
-            expected_mimetype = Config.override_ext[self.extension]
-        else:
-            expected_mimetype, encoding = mimetypes.guess_type(self.src_path,
-                                                               strict=False)
-            if expected_mimetype in Config.aliases:
-                expected_mimetype = Config.aliases[expected_mimetype]
+        if not self.has_extension:
+            return
+        expected_mimetype = self.guess_mimetype(self.src_path)
         is_known_extension = self.extension in mimetypes.types_map.keys()
+        if is_known_extension:
+            self.set_property('expected_mimetype', expected_mimetype)
         if is_known_extension and expected_mimetype != self.mimetype:
             self.make_dangerous('Mimetype does not match expected mimetype for this extension')
 
@@ -160,6 +249,8 @@ class File(FileBase):
         Determine whether the extension that are normally associated with
         the mimetype include the file's actual extension.
         """
+        if not self.has_mimetype:
+            return
         if self.mimetype in Config.aliases:
             mimetype = Config.aliases[self.mimetype]
         else:
@@ -167,6 +258,7 @@ class File(FileBase):
         expected_extensions = mimetypes.guess_all_extensions(mimetype,
                                                              strict=False)
         if expected_extensions:
+            self.set_property('expected_extensions', expected_extensions)
             if self.has_extension and self.extension not in expected_extensions:
                 self.make_dangerous('Extension does not match expected extensions for this mimetype')
 
@@ -174,39 +266,144 @@ class File(FileBase):
         if self.filename[0] is '.':
             # TODO: handle dotfiles here
             pass
-        right_to_left_override = u"\u202E"
-        if right_to_left_override in self.filename:
+        if Config.right_to_left_override in self.filename:
             self.make_dangerous('Filename contains dangerous character')
-            self.dst_path = self.dst_path.replace(right_to_left_override, '')
+            self.dst_path = self.dst_path.replace(Config.right_to_left_override, '')
             # TODO: change self.filename and'filename' property? Or should those reflect the values on the source key
 
-    def check(self):
-        self._check_dangerous()
-        self._check_filename()
-        if self.has_extension:
-            self._check_extension()
-        if self.has_mimetype:
-            self._check_mimetype()
-        if not self.is_dangerous:
-            self.mime_processing_options.get(self.main_type, self.unknown)()
+    def _check_contents(self):
+        """Process the file's contents with the handler for its mimetype."""
+        getattr(self, self.mime_processing_options.get(self.main_type, 'unknown'))()
+        self.content_checked = True
+
+    def check(self, skip=()):
+        """Run the checks in self.checks (except those named in `skip`), cheapest first."""
+        for method_name, cost, on_dangerous in sorted(self.checks, key=lambda c: c[1]):
+            if method_name in skip:
+                continue
+            if self.is_dangerous:
+                if on_dangerous == 'never':
+                    continue
+                if on_dangerous == 'diagnostics' and not self.full_diagnostics:
+                    continue
+            if self.profiler is None:
+                getattr(self, method_name)()
+            else:
+                self.profiler.run_check(self, method_name)
 
-    def write_log(self):
-        props = self.get_all_props()
-        if not self.is_recursive:
-            if os.path.exists(self.tempdir_path):
-                # Hack to make images appear at the correct tree depth in log
-                self.logger.add_file(self.src_path, props, in_tempdir=True)
+    @property
+    def verdict_is_final(self):
+        """True if the remaining checks can be skipped: dangerous and not full_diagnostics."""
+        return self.is_dangerous and not self.full_diagnostics
+
+    def _check_indicators(self, indicators):
+        """
+        Mark the file as dangerous for each (test, description) that applies.
+
+        `test` is a function returning True if the indicator is present.
+        Stops at the first indicator found unless full_diagnostics is set.
+        """
+        for test, description in indicators:
+            if self.verdict_is_final:
                 return
-        self.logger.add_file(self.src_path, props)
+            if test():
+                self.make_dangerous(description)
+
+    def check_duplicate(self, original):
+        """
+        Check a file with the same contents as the already processed `original`.
+
+        The checks based on the name of the file are run as usual, but the
+        verdict and descriptions of the mimetype handler are copied from
+        `original` instead of running the handler again. `original` must
+        have had its contents checked (see content_checked).
+        """
+        self.check(skip=('_check_contents',))
+        if self.is_dangerous:
+            return
+        descriptions = original.get_property('description_string')
+        for description in descriptions:
+            self.add_description(description)
+        if original.is_dangerous:
+            self.make_dangerous(descriptions[-1] if descriptions else None)
+        elif original.is_unknown:
+            self.make_unknown()
+        elif original.is_binary:
+            self.make_binary()
+        forced_ext = original.get_property('extension')
+        if forced_ext != original.extension:
+            self.force_ext(forced_ext)
+        if original.get_property('metadata'):
+            self.set_property('metadata', original.get_property('metadata'))
+        self.should_copy = original.should_copy
+        self.content_checked = True
+
+    def copy_duplicate(self, original):
+        """Copy the sanitized output of `original` (and its metadata file) to the destination."""
+        copies = [(original.dst_path, self.dst_path)]
+        if getattr(original, 'metadata_file_path', None):
+            ext = original.metadata_file_path[len(original.dst_path):]
+            copies.append((original.metadata_file_path, self.dst_path + ext))
+        for src, dst in copies:
+            if self.writer is not None:
+                # Queued after the writes of `original`, so src exists by then
+                self.writer.duplicate(src, dst, on_error=self._add_writer_error)
+            else:
+                self.safe_copy(src, dst)
+
+    def write_log(self):
+        self.logger.add_file(self.src_path, self.get_all_props(), self.dst_path)
+
+    def clone(self):
+        """Return a copy of the file, whose checks leave this one as it is (see update_from)."""
+        clone = copy.copy(self)
+        props = clone._file_props = dict(self._file_props)
+        for name, value in props.items():
+            if isinstance(value, (list, dict)):
+                props[name] = type(value)(value)
+        return clone
+
+    def update_from(self, clone):
+        """Take the state of `clone`, once done with it."""
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(clone, name):
+                    setattr(self, name, getattr(clone, name))
+        if hasattr(clone, '__dict__'):
+            self.__dict__.update(clone.__dict__)
+
+    def abandon(self):
+        """Drop the outputs of the file from now on, for a clone whose checks were given up on."""
+        self.writer = self.scratch = _DiscardedOutput()
 
     # ##### Helper functions #####
-    def _make_method_dict(self, list_of_tuples):
-        """Returns a dictionary with mimetype: method pairs."""
-        dict_to_return = {}
-        for list_of_subtypes, method in list_of_tuples:
-            for subtype in list_of_subtypes:
-                dict_to_return[subtype] = method
-        return dict_to_return
+    @staticmethod
+    def guess_mimetype(path):
+        """Mimetype expected for the extension of `path`, None if there is none."""
+        ext = os.path.splitext(path)[1].lower()
+        if ext in Config.override_ext:
+            return Config.override_ext[ext]
+        mimetype, encoding = mimetypes.guess_type(path, strict=False)
+        return Config.aliases.get(mimetype, mimetype)
+
+    @classmethod
+    def handler_for(cls, mimetype):
+        """Name of the method check() uses to process the contents of a file of `mimetype`."""
+        main_type = sub_type = None
+        if mimetype and '/' in mimetype:
+            main_type, sub_type = mimetype.split('/', 1)
+        method_name = cls.mime_processing_options.get(main_type, 'unknown')
+        if method_name == 'application' and sub_type:
+            method_name = '_unknown_app'
+            for subtype, subtype_method_name in cls.app_subtype_methods.items():
+                if subtype in sub_type:
+                    return subtype_method_name
+        return method_name
+
+    @property
+    def handler_name(self):
+        """Name of the method check() will use to process the file's contents."""
+        return self.handler_for(self.mimetype)
 
     @property
     def has_metadata(self):
@@ -216,11 +413,54 @@ class File(FileBase):
         return False
 
     def make_tempdir(self):
-        """Make a temporary directory at self.tempdir_path."""
-        if not os.path.exists(self.tempdir_path):
-            os.makedirs(self.tempdir_path)
+        """Make a temporary directory, its path is kept in self.tempdir_path."""
+        if self.tempdir_path is not None:
+            return self.tempdir_path
+        fallback_path = self.dst_path + '_temp'
+        if self.scratch is not None:
+            self.tempdir_path = self.scratch.make_dir(self.filename, self.size, fallback_path)
+        else:
+            # exist_ok: the destination writer may be creating parents concurrently
+            os.makedirs(fallback_path, exist_ok=True)
+            self.tempdir_path = fallback_path
         return self.tempdir_path
 
+    def remove_tempdir(self):
+        """Remove the temporary directories of the file, if any."""
+        for path in (self.tempdir_path, self.src_copy_dir):
+            if path is None:
+                continue
+            if self.scratch is not None:
+                self.scratch.release(path)
+            elif os.path.exists(path):
+                shutil.rmtree(path)
+        self.tempdir_path = None
+        self.src_copy_dir = None
+
+    def _src(self):
+        """Return the source for libraries that take a path or a file object."""
+        if self.src_data is not None:
+            return self.open_src()
+        return self.src_path
+
+    def local_src_path(self):
+        """
+        Return the path of the source on disk, for tools that can only read files.
+
+        An in-memory source is written to a temporary directory first.
+        """
+        if self.src_data is None:
+            return self.src_path
+        if self.src_copy_dir is None:
+            fallback_path = self.dst_path + '_src'
+            if self.scratch is not None:
+                self.src_copy_dir = self.scratch.make_dir(self.filename, self.size, fallback_path)
+            else:
+                self.src_copy_dir = tempfile.mkdtemp(prefix='circlean_src_')
+            with open(os.path.join(self.src_copy_dir, self.filename), 'wb') as f:
+                f.write(self.src_data)
+        return os.path.join(self.src_copy_dir, self.filename)
+
     #######################
     # ##### Discarded mimetypes, reason in the docstring ######
     def inode(self):
@@ -275,13 +515,15 @@ class File(FileBase):
 
     def application(self):
         """Process an application specific file according to its subtype."""
-        for subtype, method in self.app_subtype_methods.items():
+        # TODO: should these methods return a value?
+        self._app_subtype_method()()
+
+    def _app_subtype_method(self):
+        for subtype, method_name in self.app_subtype_methods.items():
             if subtype in self.sub_type:
                 # TODO: should we change the logic so we don't iterate through all of the subtype methods?
-                # TODO: should these methods return a value?
-                method()
-                return
-        self._unknown_app()
+                return getattr(self, method_name)
+        return self._unknown_app
 
     def _executables(self):
         """Process an executable file."""
@@ -290,13 +532,15 @@ class File(FileBase):
 
     def _winoffice(self):
         """Process a winoffice file using olefile/oletools."""
-        oid = oletools.oleid.OleID(self.src_path)  # First assume a valid file
-        if not olefile.isOleFile(self.src_path):
+        import olefile
+        import oletools.oleid
+        if not olefile.isOleFile(self._src()):
             # Manual processing, may already count as suspicious
             try:
-                ole = olefile.OleFileIO(self.src_path, raise_defects=olefile.DEFECT_INCORRECT)
+                ole = olefile.OleFileIO(self._src(), raise_defects=olefile.DEFECT_INCORRECT)
             except:
                 self.make_dangerous('Unparsable WinOffice file')
+                return
             if ole.parsing_issues:
                 self.make_dangerous('Parsing issues with WinOffice file')
             else:
@@ -304,50 +548,57 @@ class File(FileBase):
                         or ole.exists('_VBA_PROJECT_CUR') or ole.exists('VBA'):
                     self.make_dangerous('WinOffice file containing a macro')
         else:
+            if self.src_data is not None:
+                oid = oletools.oleid.OleID(data=bytes(self.src_data))
+            else:
+                oid = oletools.oleid.OleID(self.src_path)
             indicators = oid.check()
-            # Encrypted can be set by multiple checks on the script
-            if oid.encrypted.value:
-                self.make_dangerous('Encrypted WinOffice file')
-            if oid.macros.value or oid.ole.exists('macros/vba') or oid.ole.exists('Macros') \
-                    or oid.ole.exists('_VBA_PROJECT_CUR') or oid.ole.exists('VBA'):
-                self.make_dangerous('WinOffice file containing a macro')
-            for i in indicators:
-                if i.id == 'ObjectPool' and i.value:
-                    # TODO: is having an ObjectPool suspicious?
-                    # LOG: user defined property
-                    self.add_description('WinOffice file containing an object pool')
-                elif i.id == 'flash' and i.value:
-                    self.make_dangerous('WinOffice file with embedded flash')
+            self._check_indicators((
+                # Encrypted can be set by multiple checks on the script
+                (lambda: oid.encrypted.value, 'Encrypted WinOffice file'),
+                (lambda: oid.macros.value or oid.ole.exists('macros/vba') or oid.ole.exists('Macros')
+                    or oid.ole.exists('_VBA_PROJECT_CUR') or oid.ole.exists('VBA'),
+                    'WinOffice file containing a macro'),
+                (lambda: any(i.id == 'flash' and i.value for i in indicators),
+                    'WinOffice file with embedded flash'),
+            ))
+            if any(i.id == 'ObjectPool' and i.value for i in indicators):
+                # TODO: is having an ObjectPool suspicious?
+                # LOG: user defined property
+                self.add_description('WinOffice file containing an object pool')
         self.add_description('WinOffice file')
 
     def _ooxml(self):
         """Process an ooxml file."""
+        import officedissector
         try:
-            doc = officedissector.doc.Document(self.src_path)
+            doc = officedissector.doc.Document(self.local_src_path())
         except Exception:
             self.make_dangerous('Invalid ooxml file')
             return
         # There are probably other potentially malicious features:
         # fonts, custom props, custom XML
-        if doc.is_macro_enabled or len(doc.features.macros) > 0:
-            self.make_dangerous('Ooxml file containing macro')
-        if len(doc.features.embedded_controls) > 0:
-            self.make_dangerous('Ooxml file with activex')
-        if len(doc.features.embedded_objects) > 0:
+        self._check_indicators((
+            (lambda: doc.is_macro_enabled or len(doc.features.macros) > 0,
+                'Ooxml file containing macro'),
+            (lambda: len(doc.features.embedded_controls) > 0, 'Ooxml file with activex'),
             # Exploited by CVE-2014-4114 (OLE)
-            self.make_dangerous('Ooxml file with embedded objects')
-        if len(doc.features.embedded_packages) > 0:
-            self.make_dangerous('Ooxml file with embedded packages')
+            (lambda: len(doc.features.embedded_objects) > 0, 'Ooxml file with embedded objects'),
+            (lambda: len(doc.features.embedded_packages) > 0, 'Ooxml file with embedded packages'),
+        ))
 
     def _libreoffice(self):
         """Process a libreoffice file."""
         # As long as there is no way to do a sanity check on the files => dangerous
         try:
-            lodoc = zipfile.ZipFile(self.src_path, 'r')
+            lodoc = zipfile.ZipFile(self._src(), 'r')
         except:
             # TODO: are there specific exceptions we should catch here? Or should it be everything
             self.make_dangerous('Invalid libreoffice file')
+            return
         for f in lodoc.infolist():
+            if self.verdict_is_final:
+                break
             fname = f.filename.lower()
             if fname.startswith('script') or fname.startswith('basic') or \
                     fname.startswith('object') or fname.endswith('.bin'):
@@ -357,19 +608,17 @@ class File(FileBase):
 
     def _pdf(self):
         """Process a PDF file."""
-        xmlDoc = PDFiD(self.src_path)
+        from pdfid import PDFiD, cPDFiD
+        xmlDoc = PDFiD(self.local_src_path())
         oPDFiD = cPDFiD(xmlDoc, True)
         # TODO: are there other pdf characteristics which should be dangerous?
-        if oPDFiD.encrypt.count > 0:
-            self.make_dangerous('Encrypted pdf')
-        if oPDFiD.js.count > 0 or oPDFiD.javascript.count > 0:
-            self.make_dangerous('Pdf with embedded javascript')
-        if oPDFiD.aa.count > 0 or oPDFiD.openaction.count > 0:
-            self.make_dangerous('Pdf with openaction(s)')
-        if oPDFiD.richmedia.count > 0:
-            self.make_dangerous('Pdf containing flash')
-        if oPDFiD.launch.count > 0:
-            self.make_dangerous('Pdf with launch action(s)')
+        self._check_indicators((
+            (lambda: oPDFiD.encrypt.count > 0, 'Encrypted pdf'),
+            (lambda: oPDFiD.js.count > 0 or oPDFiD.javascript.count > 0, 'Pdf with embedded javascript'),
+            (lambda: oPDFiD.aa.count > 0 or oPDFiD.openaction.count > 0, 'Pdf with openaction(s)'),
+            (lambda: oPDFiD.richmedia.count > 0, 'Pdf containing flash'),
+            (lambda: oPDFiD.launch.count > 0, 'Pdf with launch action(s)'),
+        ))
         if not self.is_dangerous:
             self.add_description('Pdf file')
 
@@ -400,8 +649,9 @@ class File(FileBase):
     # Metadata extractors
     def _metadata_exif(self, metadata_file_path):
         """Read exif metadata from a jpg or tiff file using exifread."""
+        import exifread
         # TODO: can we shorten this method somehow?
-        img = open(self.src_path, 'rb')
+        img = self.open_src()
         tags = None
         try:
             tags = exifread.process_file(img, debug=True)
@@ -414,6 +664,7 @@ class File(FileBase):
                 self.add_error(e, "Failed to get any metadata for file {}.".format(self.src_path))
                 img.close()
                 return False
+        metadata_lines = []
         for tag in sorted(tags.keys()):
             # These tags are long and obnoxious/binary so we don't add them
             if tag not in ('JPEGThumbnail', 'TIFFThumbnail'):
@@ -422,8 +673,8 @@ class File(FileBase):
                 if len(tag_string) > 25 and tag_string.endswith(", ... ]"):
                     tag_value = tags[tag].values
                     tag_string = str(tag_value)
-                with open(metadata_file_path, 'w+') as metadata_file:
-                    metadata_file.write("Key: {}\tValue: {}\n".format(tag, tag_string))
+                metadata_lines.append("Key: {}\tValue: {}\n".format(tag, tag_string))
+        self.write_dst_file(metadata_file_path, ''.join(metadata_lines))
         # TODO: how do we want to log metadata?
         self.set_property('metadata', 'exif')
         img.close()
@@ -431,14 +682,16 @@ class File(FileBase):
 
     def _metadata_png(self, metadata_file_path):
         """Extract metadata from a png file using PIL/Pillow."""
+        from PIL import Image
         warnings.simplefilter('error', Image.DecompressionBombWarning)
         try:
-            img = Image.open(self.src_path)
+            img = Image.open(self._src())
+            metadata_lines = []
             for tag in sorted(img.info.keys()):
                 # These are long and obnoxious/binary
                 if tag not in ('icc_profile'):
-                    with open(metadata_file_path, 'w+') as metadata_file:
-                        metadata_file.write("Key: {}\tValue: {}\n".format(tag, img.info[tag]))
+                    metadata_lines.append("Key: {}\tValue: {}\n".format(tag, img.info[tag]))
+            self.write_dst_file(metadata_file_path, ''.join(metadata_lines))
             # LOG: handle metadata
             self.set_property('metadata', 'png')
             img.close()
@@ -451,11 +704,13 @@ class File(FileBase):
     def extract_metadata(self):
         """Create metadata file and call correct metadata extraction method."""
         metadata_file_path = self.create_metadata_file(".metadata.txt")
+        if not metadata_file_path:
+            return
         mt = self.mimetype
         metadata_processing_method = self.metadata_mimetype_methods.get(mt)
         if metadata_processing_method:
             # TODO: should we return metadata and write it here instead of in processing method?
-            metadata_processing_method(metadata_file_path)
+            getattr(self, metadata_processing_method)(metadata_file_path)
 
     #######################
     # ##### Media - audio and video aren't converted ######
@@ -478,21 +733,23 @@ class File(FileBase):
         Process an image.
 
         Extracts metadata to dest key using self.extract_metada() if metadata
-        is present. Creates a temporary directory on dest key, opens the image
-        using PIL.Image, saves it to the temporary directory, and copies it to
-        the destination.
+        is present. Creates a temporary directory (see make_tempdir), opens
+        the image using PIL.Image, saves it to the temporary directory, and
+        copies it to the destination.
         """
         # TODO: make sure this method works for png, gif, tiff
+        from PIL import Image
         if self.has_metadata:
             self.extract_metadata()
         tempdir_path = self.make_tempdir()
         tempfile_path = os.path.join(tempdir_path, self.filename)
         warnings.simplefilter('error', Image.DecompressionBombWarning)
         try:  # Do image conversions
-            img_in = Image.open(self.src_path)
+            img_in = Image.open(self._src())
             img_out = Image.frombytes(img_in.mode, img_in.size, img_in.tobytes())
             img_out.save(tempfile_path)
             self.src_path = tempfile_path
+            self.src_data = None
         except Exception as e:  # Catch decompression bombs
             # TODO: change this from all Exceptions to specific DecompressionBombWarning
             self.add_error(e, "Caught exception (possible decompression bomb?) while translating file {}.".format(self.src_path))
@@ -501,15 +758,114 @@ class File(FileBase):
             self.add_description('Image file')
 
 
+class ScratchSpace(object):
+    """
+    Local directory holding the intermediate files of a run.
+
+    Extracted archives and converted images go to a directory on a local
+    disk or tmpfs (`base_path`, the system temporary directory by default)
+    instead of the destination key, so only final outputs are written to
+    the key. Directories are reserved against a byte budget: once it is
+    used up, new directories are made at the fallback path given by the
+    caller (next to the destination file) instead. Scratch directories
+    left behind by crashed runs are removed when a new one is created.
+    """
+
+    prefix = 'circlean_scratch_'
+
+    def __init__(self, base_path=None, budget=512 * 1024 ** 2):
+        if base_path is None:
+            base_path = tempfile.gettempdir()
+        self.budget = budget
+        self.used = 0
+        self._reserved = {}  # path: bytes
+        self._count = 0
+        self._lock = threading.Lock()
+        self.remove_stale(base_path)
+        self.root_path = tempfile.mkdtemp(prefix='{}{}_'.format(self.prefix, os.getpid()),
+                                          dir=base_path)
+
+    @classmethod
+    def remove_stale(cls, base_path):
+        """Remove the scratch directories in `base_path` of processes that are gone."""
+        for name in os.listdir(base_path):
+            if not name.startswith(cls.prefix):
+                continue
+            try:
+                pid = int(name[len(cls.prefix):].split('_')[0])
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(base_path, name), ignore_errors=True)
+            except (ValueError, PermissionError):
+                continue
+
+    def make_dir(self, name, size, fallback_path):
+        """
+        Make a directory for about `size` bytes of intermediate files.
+
+        The directory is in the scratch space if the budget allows it,
+        otherwise at `fallback_path`. Call release() when done with it.
+        """
+        with self._lock:
+            if self.used + size > self.budget:
+                path = fallback_path
+            else:
+                self._count += 1
+                path = os.path.join(self.root_path, '{}_{}'.format(self._count, name))
+                self._reserved[path] = size
+                self.used += size
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def release(self, path):
+        """Remove a directory made by make_dir and give its bytes back to the budget."""
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self.used -= self._reserved.pop(path, 0)
+
+    def close(self):
+        """Remove the scratch space."""
+        shutil.rmtree(self.root_path, ignore_errors=True)
+
+
+class LogNode(object):
+    """A file or directory of the log tree."""
+
+    __slots__ = ('name', 'line', 'dst_path', 'record', 'children')
+
+    def __init__(self, name):
+        self.name = name
+        self.line = None  # Formatted log line, None if the file isn't logged
+        self.dst_path = None  # Output of the file on the destination
+        self.record = None  # JSONL record
+        self.children = {}  # name: LogNode
+
+
 class GroomerLogger(object):
-    """Groomer logging interface."""
+    """
+    Groomer logging interface.
 
-    def __init__(self, src_root_path, dst_root_path, debug=False):
+    Files and directories are added to a tree in memory, placed according to
+    their path, so they can be added in any order. finish() writes the tree
+    to the log in one pass.
+    """
+
+    def __init__(self, src_root_path, dst_root_path, debug=False, writer=None,
+                 structured_log=True):
         self._src_root_path = src_root_path
         self._dst_root_path = dst_root_path
-        self._log_dir_path = self._make_log_dir(dst_root_path)
+        self._writer = writer
+        # Only made on disk when it is written directly, not through the writer
+        self._log_dir_path = self._make_log_dir(dst_root_path, writer is None or debug)
         self.log_path = os.path.join(self._log_dir_path, 'circlean_log.txt')
-        self._add_root_dir(src_root_path)
+        # Machine readable log: one JSON record per file, with an index
+        self.structured_log = structured_log
+        self.jsonl_path = os.path.join(self._log_dir_path, 'circlean_log.jsonl')
+        self.index_path = os.path.join(self._log_dir_path, 'circlean_log.idx')
+        self._root = LogNode(os.path.split(src_root_path)[1])
+        self._root.line = self._root.name + '/'
+        self._nodes = {src_root_path: self._root}  # path: LogNode
+        self._lock = threading.Lock()
         if debug:
             self.log_debug_err = os.path.join(self._log_dir_path, 'debug_stderr.log')
             self.log_debug_out = os.path.join(self._log_dir_path, 'debug_stdout.log')
@@ -517,28 +873,58 @@ class GroomerLogger(object):
             self.log_debug_err = os.devnull
             self.log_debug_out = os.devnull
 
-    def _make_log_dir(self, root_dir_path):
+    def _make_log_dir(self, root_dir_path, create=True):
         """Make the directory in the dest dir that will hold the logs"""
         log_dir_path = os.path.join(root_dir_path, 'logs')
         if os.path.exists(log_dir_path):
             shutil.rmtree(log_dir_path)
-        os.makedirs(log_dir_path)
+        if create:
+            os.makedirs(log_dir_path)
         return log_dir_path
 
-    def _add_root_dir(self, root_path):
-        dirname = os.path.split(root_path)[1] + '/'
-        with open(self.log_path, mode='ab') as lf:
-            lf.write(bytes(dirname, 'utf-8'))
-            lf.write(b'\n')
+    def _get_node(self, path):
+        """Return the node of `path`, added under the node of its directory."""
+        with self._lock:
+            return self._get_node_locked(path)
+
+    def _get_node_locked(self, path):
+        node = self._nodes.get(path)
+        if node is None:
+            dir_path = os.path.dirname(path)
+            if dir_path == path:  # Outside of the tree
+                return self._root
+            parent = self._get_node_locked(dir_path)
+            name = os.path.basename(path)
+            node = parent.children.get(name)
+            if node is None:
+                node = parent.children[name] = LogNode(name)
+            self._nodes[path] = node
+        return node
+
+    def add_file(self, file_path, file_props, dst_path=None):
+        """
+        Add a file to the log. Takes a dict of file properties.
+
+        The file is placed in the tree by its original path (the 'filepath'
+        property), `file_path` is the file actually hashed and `dst_path`
+        its output.
+        """
+        node = self._get_node(file_props['filepath'])
+        node.line = self._file_line(file_path, file_props)
+        node.dst_path = dst_path
 
-    def add_file(self, file_path, file_props, in_tempdir=False):
-        """Add a file to the log. Takes a dict of file properties."""
+    def _file_line(self, file_path, file_props):
+        """Return the log line of a file."""
         # TODO: fix var names in this method
         # TODO: handle symlinks better: symlink_string = '{}+-- {}\t- Symbolic link to {}\n'.format(padding, f, os.readlink(curpath))
         props = file_props
-        depth = self._get_path_depth(file_path)
         description_string = ', '.join(props['description_string'])
-        file_hash = Logging.computehash(file_path)[:6]
+        digest = None
+        if file_path == props['filepath']:
+            digest = props['user_defined'].get('sha256')
+        if digest is None:
+            digest = Logging.computehash(file_path)
+        file_hash = digest[:6]
         if props['safety_category'] is None:
             descr_cat = "Normal"
         else:
@@ -556,81 +942,935 @@ class GroomerLogger(object):
             desc_str=description_string,
             # errs=''  # TODO: add errors in human readable form here
         )
-        if in_tempdir:
-            depth -= 1
-        self._write_line_to_log(file_string, depth)
+        return file_string
 
     def add_dir(self, dir_path):
-        path_depth = self._get_path_depth(dir_path)
-        dirname = os.path.split(dir_path)[1] + '/'
-        log_line = '+- ' + dirname
-        self._write_line_to_log(log_line, path_depth)
-
-    def _get_path_depth(self, path):
-        if self._dst_root_path in path:
-            base_path = self._dst_root_path
-        elif self._src_root_path in path:
-            base_path = self._src_root_path
-        relpath = os.path.relpath(path, base_path)
-        path_depth = relpath.count(os.path.sep)
-        return path_depth
-
-    def _write_line_to_log(self, line, indentation_depth):
-        padding = b'   '
-        padding += b'|  ' * indentation_depth
-        line_bytes = os.fsencode(line)
-        with open(self.log_path, mode='ab') as lf:
-            lf.write(padding)
-            lf.write(line_bytes)
-            lf.write(b'\n')
+        node = self._get_node(dir_path)
+        node.line = '+- ' + node.name + '/'
+
+    def add_archive_dir(self, dir_path, archive_path):
+        """Log the contents of `dir_path` as the members of the archive at `archive_path`."""
+        node = self._get_node(archive_path)
+        with self._lock:
+            self._nodes[dir_path] = node
+
+    def add_record(self, result, path, handler_name, processing_time):
+        """
+        Add the FileResult of a file to the JSONL log.
+
+        `path` is the path of the file in the source (through archives),
+        `handler_name` and `processing_time` how it was processed.
+        """
+        record = (result, path, handler_name, processing_time)
+        self._get_node(result.get_property('filepath')).record = record
+
+    def _make_record(self, result, path, handler_name, processing_time, write_errors=None):
+        """
+        Return the JSONL log record (a dict) of a file.
+
+        `write_errors` maps the destination paths that failed to be written
+        to their error (see finish).
+        """
+        props = result.get_all_props()
+        record = {
+            'path': path,
+            'dst_path': result.dst_path,
+            'mimetype': result.mimetype,
+            'handler': handler_name,
+            'processing_time': processing_time,
+            'descriptions': props['description_string'],
+            'errors': [{'type': type(error).__name__, 'error': str(error), 'info': info}
+                       for error, info in props['errors'].items()],
+            'properties': dict(props['user_defined']),
+        }
+        for key, value in props.items():
+            if key not in ('description_string', 'errors', 'user_defined'):
+                record[key] = value
+        record['sha256'] = record['properties'].pop('sha256', None)
+        for dst_path in (result.dst_path, result.metadata_file_path):
+            error = (write_errors or {}).get(dst_path)
+            if error is not None:
+                record['errors'].append({'type': type(error).__name__, 'error': str(error),
+                                         'info': 'Error while writing to the destination'})
+                if dst_path == result.dst_path:
+                    record['copied'] = False
+        return record
+
+    def _walk(self):
+        """Yield (depth, node) for the nodes of the tree, in log order."""
+        stack = [(-1, self._root)]
+        while stack:
+            depth, node = stack.pop()
+            yield depth, node
+            children = sorted(node.children.values(), key=lambda n: (n.name.lower(), n.name),
+                              reverse=True)
+            stack.extend((depth + 1, child) for child in children)
+
+    def finish(self, summary=(), write_errors=None):
+        """
+        Write the logs, call once all files are added.
+
+        The lines of `summary` are written after the tree. `write_errors`
+        maps destination paths to the error that prevented writing them,
+        for the writes that failed after their file was logged.
+        """
+        write_errors = write_errors or {}
+        lines = []
+        jsonl_lines = []
+        jsonl_offset = 0
+        index = {'paths': {}, 'sha256': {}, 'log': os.path.basename(self.jsonl_path)}
+        for depth, node in self._walk():
+            if node.line is not None:
+                padding = b'   ' + b'|  ' * depth if depth >= 0 else b''
+                line = node.line
+                if node.dst_path in write_errors:
+                    line += ' Not written: {}'.format(write_errors[node.dst_path])
+                lines.append(padding + os.fsencode(line) + b'\n')
+            if node.record is not None and self.structured_log:
+                record = self._make_record(*node.record, write_errors=write_errors)
+                line = bytes(json.dumps(record, sort_keys=True, default=str), 'utf-8') + b'\n'
+                index['paths'][record['path']] = jsonl_offset
+                if record.get('sha256'):
+                    index['sha256'].setdefault(record['sha256'], []).append(jsonl_offset)
+                jsonl_lines.append(line)
+                jsonl_offset += len(line)
+        if summary:
+            lines.append(b'\n')
+            lines.extend(os.fsencode(line) + b'\n' for line in summary)
+        self._write_log_file(self.log_path, b''.join(lines))
+        if self.structured_log:
+            self._write_log_file(self.jsonl_path, b''.join(jsonl_lines))
+            self._write_log_file(self.index_path,
+                                 bytes(json.dumps(index, sort_keys=True), 'utf-8'))
+
+    def _write_log_file(self, path, data):
+        if self._writer is not None:
+            self._writer.write(path, data)
+        else:
+            with open(path, 'wb') as log_file:
+                log_file.write(data)
+
+
+def lookup_run_log(log_dir_path, path=None, sha256=None):
+    """
+    Return the JSONL log records of a run matching `path` or `sha256`.
+
+    Uses the index written next to the log, so only the matching records are
+    read. `log_dir_path` is the logs directory of the run.
+    """
+    with open(os.path.join(log_dir_path, 'circlean_log.idx')) as index_file:
+        index = json.load(index_file)
+    offsets = []
+    if path is not None and path in index['paths']:
+        offsets.append(index['paths'][path])
+    if sha256 is not None:
+        offsets += [offset for offset in index['sha256'].get(sha256, []) if offset not in offsets]
+    records = []
+    with open(os.path.join(log_dir_path, index['log']), 'rb') as jsonl_file:
+        for offset in offsets:
+            jsonl_file.seek(offset)
+            records.append(json.loads(jsonl_file.readline().decode('utf-8')))
+    return records
+
+
+class CostScheduler(object):
+    """
+    Estimate how long files take to process to schedule the slow ones first.
+
+    The cost of a file is modelled as `fixed + size * per_byte` seconds, with
+    coefficients depending on the handler that processes the file. Starting
+    from `default_costs`, the coefficients are refined with a least squares
+    fit over the timings recorded by record(). These statistics can be kept
+    between runs in a JSON file at `stats_path`.
+    """
+
+    # handler name: (fixed seconds, seconds per byte)
+    default_costs = {
+        '_pdf': (0.05, 2e-8),
+        '_winoffice': (0.05, 1e-8),
+        '_ooxml': (0.1, 2e-8),
+        '_libreoffice': (0.02, 1e-8),
+        '_archive': (0.1, 5e-8),
+        'image': (0.02, 5e-8),
+    }
+    default_cost = (0.001, 1e-9)  # Plain copy
+    min_samples = 3
+
+    def __init__(self, stats_path=None):
+        self.stats_path = stats_path
+        self.stats = {}  # handler name: [n, sum_size, sum_time, sum_size2, sum_size_time]
+        self._lock = threading.Lock()
+        if stats_path is not None and os.path.exists(stats_path):
+            with open(stats_path) as stats_file:
+                self.stats = json.load(stats_file)
+
+    def estimate(self, handler_name, size):
+        """Return the expected processing time in seconds of a file."""
+        fixed, per_byte = self.coefficients(handler_name)
+        return fixed + size * per_byte
+
+    def is_expensive(self, handler_name):
+        """True if the handler analyses the contents of the files, instead of just copying them."""
+        return handler_name in self.default_costs
+
+    def coefficients(self, handler_name):
+        """Return the (fixed, per_byte) cost coefficients for a handler."""
+        default = self.default_costs.get(handler_name, self.default_cost)
+        stats = self.stats.get(handler_name)
+        if stats is None or stats[0] < self.min_samples:
+            return default
+        n, sum_size, sum_time, sum_size2, sum_size_time = stats
+        variance = n * sum_size2 - sum_size ** 2
+        if variance <= 0:
+            # All the samples have the same size, only the mean is known
+            return (max(sum_time / n - default[1] * sum_size / n, 0), default[1])
+        per_byte = max((n * sum_size_time - sum_size * sum_time) / variance, 0)
+        fixed = max((sum_time - per_byte * sum_size) / n, 0)
+        return (fixed, per_byte)
+
+    def record(self, handler_name, size, seconds):
+        """Record the time it took a handler to process a file of `size` bytes."""
+        with self._lock:
+            stats = self.stats.setdefault(handler_name, [0, 0, 0.0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += seconds
+            stats[3] += size * size
+            stats[4] += size * seconds
+
+    def order(self, files):
+        """Return `files` sorted longest expected processing time first."""
+        return sorted(files, key=lambda f: self.estimate(f.handler_name, f.get_property('file_size')),
+                      reverse=True)
+
+    def save(self):
+        """Write the statistics to stats_path, if set."""
+        if self.stats_path is None:
+            return
+        tmp_path = self.stats_path + '.tmp'
+        with self._lock, open(tmp_path, 'w') as stats_file:
+            json.dump(self.stats, stats_file)
+        os.replace(tmp_path, self.stats_path)
+
+
+class ResultStore(object):
+    """
+    Results of all the files of a run, stored by column.
+
+    Each column is an array (or a list for the paths) indexed by file id.
+    Strings repeated across files (safety categories, mimetypes, handler
+    names) are stored as codes, so a row only takes a few tens of bytes.
+    Counts and totals per code are kept up to date as files are added, so
+    the aggregate queries don't depend on the number of files.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.sizes = array.array('q')
+        self.times = array.array('d')
+        self.categories = array.array('B')
+        self.mimetypes = array.array('I')
+        self.handlers = array.array('I')
+        # column: [value of each code], column: {value: code}
+        self._values = {'categories': [], 'mimetypes': [], 'handlers': []}
+        self._codes = {'categories': {}, 'mimetypes': {}, 'handlers': {}}
+        # column: [number of files of each code]
+        self._counts = {'categories': [], 'mimetypes': [], 'handlers': []}
+        self._category_bytes = []
+        self._handler_times = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _code(self, column, value):
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self._values[column])
+            self._values[column].append(value)
+            self._counts[column].append(0)
+            if column == 'categories':
+                self._category_bytes.append(0)
+            elif column == 'handlers':
+                self._handler_times.append(0.)
+        self._counts[column][code] += 1
+        return code
+
+    def add(self, path, size, safety_category, mimetype, handler_name, processing_time):
+        """Add the result of a file, return its id."""
+        with self._lock:
+            category = self._code('categories', safety_category or 'normal')
+            handler = self._code('handlers', handler_name)
+            self._category_bytes[category] += size
+            self._handler_times[handler] += processing_time
+            self.paths.append(path)
+            self.sizes.append(size)
+            self.times.append(processing_time)
+            self.categories.append(category)
+            self.mimetypes.append(self._code('mimetypes', mimetype or 'unknown'))
+            self.handlers.append(handler)
+            return len(self.paths) - 1
+
+    def _by_value(self, column, totals):
+        return dict(zip(self._values[column], totals))
+
+    def count_by_mimetype(self):
+        """Return {mimetype: number of files}."""
+        return self._by_value('mimetypes', self._counts['mimetypes'])
+
+    def count_by_category(self):
+        """Return {safety category: number of files}, 'normal' if not set."""
+        return self._by_value('categories', self._counts['categories'])
+
+    def bytes_by_category(self):
+        """Return {safety category: total size in bytes}."""
+        return self._by_value('categories', self._category_bytes)
+
+    def largest(self, safety_category=None, count=10):
+        """Return the `count` largest files, as (path, size), optionally only those in `safety_category`."""
+        rows = zip(self.sizes, itertools.count())
+        if safety_category is not None:
+            code = self._codes['categories'].get(safety_category)
+            if code is None:
+                return []
+            rows = itertools.compress(rows, map(code.__eq__, self.categories))
+        return [(self.paths[i], size) for size, i in heapq.nlargest(count, rows)]
+
+    def slowest_handlers(self, count=5):
+        """Return the `count` handlers with the highest total time, as (handler, seconds, files)."""
+        times = self._by_value('handlers', self._handler_times)
+        files = self._by_value('handlers', self._counts['handlers'])
+        slowest = heapq.nlargest(count, times, key=times.get)
+        return [(handler, times[handler], files[handler]) for handler in slowest]
+
+    def summary_lines(self):
+        """
+        Return the summary of the run as lines of text for the log.
+
+        Timings are left out so that the log of a run doesn't depend on how
+        fast it was processed.
+        """
+        if not self.paths:
+            return ['Summary: no files']
+        lines = ['Summary: {} files, {}B'.format(len(self.paths), sum(self._category_bytes))]
+        counts = self.count_by_category()
+        for category, size in sorted(self.bytes_by_category().items()):
+            lines.append('   {}: {} files, {}B'.format(category.capitalize(), counts[category], size))
+        mimetypes = sorted(self.count_by_mimetype().items(), key=lambda item: (-item[1], item[0]))
+        lines.append('   Mimetypes: ' + ', '.join('{} ({})'.format(*item) for item in mimetypes))
+        dangerous = self.largest('dangerous', 5)
+        if dangerous:
+            # Dangerous names are made to deceive: escape them (see File._check_filename)
+            lines.append('   Largest dangerous files: ' + ', '.join(
+                '{} ({}B)'.format(_escape_name(path), size) for path, size in dangerous))
+        return lines
+
+
+class FileProfiler(object):
+    """
+    Profile the checks of every file, to find why a source is slow or uses a lot of memory.
+
+    Every check run by File.check is a stage, named after the handler for
+    _check_contents. With `profile`, the checks of the files of each
+    handler are profiled together with cProfile. With `trace_memory`,
+    tracemalloc records the peak memory of every stage: it is restarted
+    before each stage, so the peak only counts the memory allocated by
+    that stage (tracemalloc.reset_peak needs Python 3.9). report() lists
+    the `count` slowest files and largest memory peaks, and the
+    cumulative function stats of every handler. Files must be processed
+    one at a time.
+    """
+
+    def __init__(self, profile=True, trace_memory=False, count=10):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.count = count
+        self.profiles = {}  # Handler name: cProfile.Profile of its checks
+        self.files = []  # (path, handler name, seconds, [(stage, seconds, peak bytes)])
+        # Source path (filepath): [(stage, seconds, peak bytes)] until the file is done. Not
+        # keyed by File, whose checks may run on a clone (see File.clone)
+        self._stages = {}
+        self._started_tracing = False  # Else tracemalloc was already running, close() leaves it on
+        if trace_memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+
+    def run_check(self, file, method_name):
+        """Run the check `method_name` of `file`, profiled."""
+        # Imported here, like the analysis dependencies, to keep the import fast
+        import cProfile
+        import tracemalloc
+        handler_name = file.handler_name
+        stage = handler_name if method_name == '_check_contents' else method_name
+        profile = None
+        if self.profile:
+            profile = self.profiles.setdefault(handler_name, cProfile.Profile())
+        if self.trace_memory:
+            tracemalloc.stop()
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        try:
+            if profile is None:
+                getattr(file, method_name)()
+            else:
+                profile.runcall(getattr(file, method_name))
+        finally:
+            elapsed = time.perf_counter() - start_time
+            peak = 0
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+            self._stages.setdefault(file.get_property('filepath'), []).append((stage, elapsed, peak))
+
+    def file_done(self, file, path, handler_name, seconds):
+        """Record the stages of `file`, processed in `seconds`."""
+        self.files.append((path, handler_name, seconds, self._stages.pop(file.get_property('filepath'), [])))
+
+    def close(self):
+        if self._started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def report(self):
+        """Return the report, as text."""
+        import pstats
+        lines = ['Slowest files:']
+        for path, handler_name, seconds, stages in heapq.nlargest(self.count, self.files,
+                                                                  key=lambda f: f[2]):
+            lines.append('   {:8.3f}s {} ({}): {}'.format(seconds, path, handler_name, ', '.join(
+                '{} {:.3f}s'.format(stage, elapsed) for stage, elapsed, peak in stages)))
+        if self.trace_memory:
+            lines.append('Largest memory peaks:')
+            peaks = [(max([peak for stage, elapsed, peak in stages], default=0), path, handler_name, stages)
+                     for path, handler_name, seconds, stages in self.files]
+            for peak, path, handler_name, stages in heapq.nlargest(self.count, peaks, key=lambda f: f[0]):
+                lines.append('   {:8.1f}KB {} ({}): {}'.format(peak / 1024, path, handler_name, ', '.join(
+                    '{} {:.1f}KB'.format(stage, stage_peak / 1024) for stage, elapsed, stage_peak in stages)))
+        for handler_name, profile in sorted(self.profiles.items()):
+            lines.append('Functions of {} (cumulative):'.format(handler_name))
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(self.count * 2)
+            lines.append(stream.getvalue())
+        return '\n'.join(lines) + '\n'
+
+
+class InsufficientSpace(KittenGroomerError):
+    """The output is not expected to fit on the destination."""
+    pass
+
+
+class CapacityPlanner(object):
+    """
+    Preflight estimate of the space the output will take on the destination.
+
+    add() estimates the output of a source file: the file itself (forcing
+    its extension doesn't change its size), the metadata file of images
+    with metadata, and for archives their members, from the 7z listing,
+    instead of the archive. Every output file takes a whole number of
+    clusters. plan() compares the total with the free space.
+    """
+
+    policies = ('abort', 'order', 'smallest')
+    # Kept free for the logs and the directories
+    reserve = 4 * 1024 ** 2
+    # Estimated size of a metadata file: the EXIF or PNG text fields of an image
+    metadata_size = 16 * 1024
+
+    def __init__(self, dst_path):
+        stats = os.statvfs(dst_path)
+        self.cluster_size = stats.f_frsize
+        self.available = stats.f_bavail * stats.f_frsize
+        # Source path: estimated bytes on the destination, in source order
+        self.sizes = collections.OrderedDict()
+
+    def _on_disk(self, size):
+        return max(-(-size // self.cluster_size), 1) * self.cluster_size
+
+    def add(self, path, size, handler_name, has_metadata=False):
+        """Estimate the output of the source file at `path`, of `size` bytes, checked by `handler_name`."""
+        sizes = None
+        if handler_name == '_archive':
+            # Nested archives are counted as they are, not expanded
+            sizes = self._list_archive(path)
+        elif handler_name == 'image':
+            size = self._image_size(path, size)
+        if sizes is None:
+            sizes = [size]
+            if has_metadata:
+                sizes.append(self.metadata_size)
+        self.sizes[path] = sum(self._on_disk(size) for size in sizes)
+
+    def _list_archive(self, path):
+        """Return the sizes of the files in the archive at `path`, None if it can't be listed."""
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                output = subprocess.check_output([SEVENZ_PATH, 'l', '-slt', '-p1', path],
+                                                 stderr=devnull, timeout=60)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        _, separator, listing = output.decode('utf-8', 'replace').partition('\n----------\n')
+        if not separator:
+            return None
+        sizes = []
+        for block in listing.split('\n\n'):
+            entry = dict(line.split(' = ', 1) for line in block.splitlines() if ' = ' in line)
+            if 'Path' in entry and entry.get('Folder') != '+':
+                sizes.append(int(entry.get('Size') or 0))
+        return sizes
+
+    def _image_size(self, path, size):
+        """Images are saved again, without compression for the formats where it isn't the default."""
+        from PIL import Image
+        try:
+            with Image.open(path) as image:
+                if image.format in ('TIFF', 'BMP'):
+                    width, height = image.size
+                    return max(size, width * height * len(image.getbands()))
+        except Exception:
+            pass
+        return size
+
+    @property
+    def total(self):
+        return sum(self.sizes.values()) + self.reserve
+
+    def plan(self, policy):
+        """
+        Return the source paths of the files not to copy for the output to fit.
+
+        If it doesn't fit, the 'abort' policy raises InsufficientSpace, the
+        others keep the files that fit, in source order ('order') or
+        smallest first ('smallest').
+        """
+        if policy not in self.policies:
+            raise ValueError('Unknown capacity policy: {}'.format(policy))
+        if self.total <= self.available:
+            return set()
+        if policy == 'abort':
+            raise InsufficientSpace('The output needs about {} MB on the destination, {} MB are free'.format(
+                self.total // 1024 ** 2, self.available // 1024 ** 2))
+        paths = list(self.sizes)
+        if policy == 'smallest':
+            paths.sort(key=self.sizes.get)
+        space_left = self.available - self.reserve
+        not_copied = set()
+        for path in paths:
+            if self.sizes[path] <= space_left:
+                space_left -= self.sizes[path]
+            else:
+                not_copied.add(path)
+        return not_copied
+
+
+class CheckRunner(object):
+    """
+    Daemon threads running checks that can be given up on.
+
+    run() waits for a call at most `timeout` seconds. A call still running
+    then keeps its thread until it returns, the other threads are reused.
+    """
+
+    def __init__(self):
+        self._idle = []  # Inboxes of the idle threads
+        self._lock = threading.Lock()
+
+    def run(self, function, timeout):
+        """Call function() in a runner thread, return False if it didn't return within `timeout` seconds."""
+        with self._lock:
+            inbox = self._idle.pop() if self._idle else None
+        if inbox is None:
+            inbox = queue.Queue(1)
+            threading.Thread(target=self._serve, args=(inbox,), name='circlean-check', daemon=True).start()
+        done = threading.Event()
+        errors = []
+        inbox.put((function, done, errors))
+        if not done.wait(max(timeout, 0)):
+            return False
+        if errors:
+            raise errors[0]
+        return True
+
+    def _serve(self, inbox):
+        while True:
+            function, done, errors = inbox.get()
+            try:
+                function()
+            except Exception as e:
+                errors.append(e)
+            with self._lock:
+                self._idle.append(inbox)
+            done.set()
+
+
+class GroomRequest(object):
+    """State of a file processed on its own, with its archive members (see process_buffer)."""
+
+    __slots__ = ('results', 'cancelled', 'loop', 'processes', 'run_process')
+
+    def __init__(self, loop=None, run_process=None):
+        self.results = []  # FileResults of the file and its members
+        self.cancelled = threading.Event()
+        self.loop = loop  # Event loop running the subprocesses, for AsyncGroomer
+        self.processes = set()  # Subprocesses running in the loop
+        # Called as run_process(args, stdout, stderr, timeout) to run the
+        # subprocesses instead of the subprocess module, returns True on success
+        self.run_process = run_process
+
+    def cancel(self):
+        """Stop the processing. With a loop, call from the loop."""
+        self.cancelled.set()
+        for process in self.processes:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
 
 
 class KittenGroomerFileCheck(KittenGroomerBase):
 
-    def __init__(self, root_src, root_dst, max_recursive_depth=2, debug=False):
+    def __init__(self, root_src, root_dst, max_recursive_depth=2, debug=False,
+                 write_behind=True, dedup=False, workers=1, cost_stats_path=None,
+                 scan_only=False, full_diagnostics=False, progress_callback=None,
+                 progress_interval=0.5, structured_log=True, scratch_path=None,
+                 scratch_budget=512 * 1024 ** 2, writer=None, archive_format=None,
+                 time_budget=None, capacity_policy=None, profile=False, trace_memory=False,
+                 profile_count=10):
         super(KittenGroomerFileCheck, self).__init__(root_src, root_dst)
-        self.recursive_archive_depth = 0
+        # Per thread, so that files can be processed in parallel
+        self._local = threading.local()
         self.max_recursive_depth = max_recursive_depth
-        self.cur_file = None
-        self.logger = GroomerLogger(root_src, root_dst, debug)
+        # With dedup, files whose sha256 was already seen reuse the earlier verdict
+        self.dedup = dedup
+        self.seen_files = {}  # sha256: FileResult of the first file with this content
+        # Writes to the destination are queued and fsynced once at the end of run()
+        # A writer can be passed instead, e.g. a MemoryWriter to keep the output in memory
+        # With archive_format ('zip' or 'tar'), the destination is a single archive
+        if writer is None and archive_format is not None:
+            writer = ArchiveWriter(os.path.join(root_dst, 'circlean.' + archive_format),
+                                   root_dst, archive_format)
+        elif writer is None and write_behind:
+            writer = DestinationWriter()
+        self.writer = writer
+        # In scan-only mode files are checked but nothing but the log and the
+        # report is written to the destination. Temporary files (extracted
+        # archives, converted images) go to a local directory instead.
+        self.scan_only = scan_only
+        self.report = []  # Filled in scan-only mode, (path, FileResult) per file
+        self.report_path = None
+        if scan_only:
+            self.output_root_path = tempfile.mkdtemp(prefix='circlean_scan_')
+            # Files only write temporary data, synchronously to the local disk
+            self.file_writer = None
+        else:
+            self.output_root_path = self.dst_root_path
+            self.file_writer = self.writer
+        # Intermediate files are kept off the destination, within scratch_budget bytes
+        self.scratch = ScratchSpace(scratch_path, scratch_budget)
+        # Also write a JSONL log with a record per file (see lookup_run_log)
+        self.structured_log = structured_log
+        self.logger = GroomerLogger(root_src, root_dst, debug, self.writer, structured_log)
+        # Keep checking dangerous files to log every reason (slower)
+        self.full_diagnostics = full_diagnostics
+        # progress_callback gets a Progress at most every progress_interval seconds
+        self.progress = None
+        if progress_callback is not None:
+            self.progress = ProgressTracker(progress_callback, progress_interval)
+        # With several workers, files are processed in parallel, slowest first
+        self.workers = workers
+        self._executor = None  # Set while files are processed in parallel
+        self._results = None  # Queue of the FileResults for iter_process()
+        self._stop = threading.Event()
+        self.scheduler = CostScheduler(cost_stats_path)
+        # Results of every file, for summaries (see ResultStore)
+        self.results = ResultStore()
+        # With a time budget (in seconds, from the start of the processing),
+        # files whose expected processing time doesn't fit in the time left
+        # are logged without checking their contents nor copying them
+        self.time_budget = time_budget
+        self._deadline = None
+        self._check_runner = CheckRunner() if time_budget is not None else None
+        self.skipped = []  # Paths of the files skipped to stay within the budget
+        # With a capacity policy (see CapacityPlanner.policies), the size of
+        # the output is estimated before processing. If it doesn't fit on
+        # the destination, 'abort' raises InsufficientSpace and the other
+        # policies choose the files not to copy.
+        self.capacity_policy = capacity_policy
+        self.not_copied = set()  # Source paths of the files not copied for lack of space
+        # Profile the checks (see FileProfiler), the report is written next to the log
+        self.profiler = None
+        self.profile_path = None
+        if profile or trace_memory:
+            self.profiler = FileProfiler(profile, trace_memory, profile_count)
+            # The profilers and tracemalloc can't tell files apart in parallel
+            self.workers = 1
+
+    @property
+    def cur_file(self):
+        return getattr(self._local, 'cur_file', None)
 
-    def process_dir(self, src_dir, dst_dir):
-        """Process a directory on the source key."""
-        for srcpath in self.list_files_dirs(src_dir):
+    @property
+    def _request(self):
+        """The GroomRequest processed by the current thread, if any."""
+        return getattr(self._local, 'request', None)
+
+    @cur_file.setter
+    def cur_file(self, value):
+        self._local.cur_file = value
+
+    def process_dir(self, src_dir, dst_dir, logger=None, depth=0):
+        """
+        Process a directory on the source key.
+
+        `depth` is the number of archives the directory is in.
+        """
+        self._process_entries(self.list_files_dirs(src_dir), dst_dir, logger, depth)
+
+    def _process_entries(self, entries, dst_dir, logger=None, depth=0):
+        """Process the files and directories at the paths in `entries`, in tree order."""
+        if logger is None:
+            logger = self.logger
+        files = []
+        for srcpath in entries:
             if os.path.isdir(srcpath):
-                self.logger.add_dir(srcpath)
+                logger.add_dir(srcpath)
             else:
                 dstpath = os.path.join(dst_dir, os.path.basename(srcpath))
-                self.cur_file = File(srcpath, dstpath, self.logger)
-                self.process_file(self.cur_file)
+                files.append(self._make_file(srcpath, dstpath, logger))
+        if self._executor is None or self._request is not None:
+            # Files of a request stay in its thread, with its state
+            for file in files:
+                self._process_task(file, depth)
+        else:
+            # Slowest first, each file a task carrying its depth
+            self._run_tasks([functools.partial(self._process_task, file, depth)
+                             for file in self.scheduler.order(files)])
+
+    def _process_task(self, file, depth):
+        if self._stop.is_set() or self._cancelled():
+            return
+        self.cur_file = file
+        self.process_file(file, depth)
 
-    def process_file(self, file):
+    def _run_tasks(self, tasks):
+        """
+        Run the callables in `tasks` on the idle workers of self._executor.
+
+        The calling thread runs tasks as well, and only waits for tasks that
+        already started, so this can be called from a task itself (archive
+        members are run this way) without a deadlock.
+        """
+        queue = collections.deque(tasks)
+        cond = threading.Condition()
+        running = [0]
+        errors = []
+
+        def run_queued():
+            while True:
+                with cond:
+                    if not queue:
+                        return
+                    task = queue.popleft()
+                    running[0] += 1
+                try:
+                    task()
+                except BaseException as e:
+                    errors.append(e)
+                finally:
+                    with cond:
+                        running[0] -= 1
+                        cond.notify_all()
+
+        for _ in range(min(self.workers, len(queue)) - 1):
+            self._executor.submit(run_queued)
+        run_queued()
+        with cond:
+            while running[0]:
+                cond.wait()
+        if errors:
+            raise errors[0]
+
+    def _make_file(self, src_path, dst_path, logger, src_data=None):
+        return File(src_path, dst_path, logger, self.file_writer, self.full_diagnostics,
+                    self.scratch, src_data, self.profiler)
+
+    def process_file(self, file, depth=0):
         """
         Process an individual file.
 
         Check the file, handle archives using self.process_archive, copy
         the file to the destionation key, and clean up temporary directory.
+        `depth` is the number of archives the file is in.
+        """
+        start_time = time.perf_counter()
+        handler_name = file.handler_name
+        if self.progress is not None:
+            self.progress.start_file(self._display_path(file))
+        # Hash the source before it may be replaced by a converted file. The
+        # log needs it anyway, and in-memory sources can only be hashed here.
+        file.set_property('sha256', file.compute_hash())
+        duplicate = self.dedup and self._process_duplicate(file)
+        if not duplicate:
+            self._check_and_copy(file, depth)
+        elapsed = time.perf_counter() - start_time
+        if file.content_checked and not duplicate:
+            # Only the files the handler ran on tell what it costs: the others
+            # (skipped, dangerous by name, duplicates) would make it look free
+            self.scheduler.record(handler_name, file.get_property('file_size'), elapsed)
+        path = self._display_path(file)
+        self.results.add(path, file.get_property('file_size'), file.get_property('safety_category'),
+                         file.mimetype, handler_name, elapsed)
+        result = file.result(path)
+        if self.scan_only:
+            self.report.append((path, result))
+        if self.structured_log:
+            file.logger.add_record(result, path, handler_name, elapsed)
+        if self._results is not None:
+            self._results.put(result)
+        if self._request is not None:
+            self._request.results.append(result)
+        if self.profiler is not None:
+            self.profiler.file_done(file, path, handler_name, elapsed)
+        if self.progress is not None and depth == 0:
+            # Archive members aren't part of the size index of the source
+            self.progress.file_done(file.get_property('file_size'))
+
+    def _cancelled(self):
+        request = self._request
+        return request is not None and request.cancelled.is_set()
+
+    def _time_left(self):
+        """Seconds until the end of the time budget, None without a budget."""
+        if self._deadline is None:
+            return None
+        return self._deadline - time.monotonic()
+
+    def _out_of_time(self, file):
+        """
+        True if `file` is not to be processed to stay within the time budget.
+
+        Once the budget is used up, no file is. Before that, files that are
+        not expected to be processed in the time left are only skipped if
+        their handler is expensive: the others run, bounded by _check_in_time.
+        """
+        time_left = self._time_left()
+        if time_left is None:
+            return False
+        if time_left <= 0:
+            return True
+        handler_name = file.handler_name
+        return self.scheduler.is_expensive(handler_name) and \
+            self.scheduler.estimate(handler_name, file.get_property('file_size')) > time_left
+
+    def _check_in_time(self, file):
+        """
+        Run file.check(), give up at the end of the time budget.
+
+        Returns False if the checks didn't finish in time. They can't be
+        interrupted, so they run on a clone of `file`: given up on, the clone
+        goes on in the background, but its outputs are dropped and `file`
+        doesn't change any more.
         """
-        file.check()
+        time_left = self._time_left()
+        if time_left is None:
+            file.check()
+            return True
+        checking = file.clone()
+        if self._check_runner.run(checking.check, time_left):
+            file.update_from(checking)
+            return True
+        checking.abandon()
+        file.make_dangerous('Not fully checked: out of time')
+        self.skipped.append(self._display_path(file))
+        return False
+
+    def _skip_file(self, file):
+        """Log `file` without checking its contents (or expanding it) nor copying it."""
+        file.check(skip=('_check_contents',))
+        file.make_dangerous('Not checked: out of time')
+        file.write_log()
+        self.skipped.append(self._display_path(file))
+
+    def _check_without_copy(self, file):
+        """Check and log `file` without copying it (or expanding it)."""
+        self._check_in_time(file)
+        file.add_description('Not copied: not enough space on the destination')
+        file.write_log()
+        file.remove_tempdir()
+
+    def _check_and_copy(self, file, depth=0):
+        if self._out_of_time(file):
+            self._skip_file(file)
+            return
+        if file.get_property('filepath') in self.not_copied:
+            self._check_without_copy(file)
+            return
+        if not self._check_in_time(file):
+            file.write_log()
+            return
+        if self._cancelled():
+            # The checks may have been cut short
+            file.make_dangerous('Processing cancelled')
         if file.should_copy:
-            file.safe_copy()
-            file.set_property('copied', True)
+            if not self.scan_only:
+                file.safe_copy()
+                file.set_property('copied', True)
             file.write_log()
         if file.is_recursive:
-            self.process_archive(file)
-        # TODO: Can probably handle cleaning up the tempdir better
-        if hasattr(file, 'tempdir_path'):
-            self.safe_rmtree(file.tempdir_path)
+            self.process_archive(file, depth)
+            if self._cancelled():
+                # Members may have been skipped
+                file.make_dangerous('Processing cancelled')
+        file.remove_tempdir()
+        if self.dedup and file.content_checked and not file.is_recursive:
+            # Only once its output is queued can it be reused for duplicates
+            self.seen_files.setdefault(file.get_property('sha256'), file.result())
+
+    def _process_duplicate(self, file):
+        """
+        Handle `file` as a duplicate if its contents were already processed.
 
-    def process_archive(self, file):
+        Returns True if it was, False if it has to be processed normally.
+        """
+        original = self.seen_files.get(file.get_property('sha256'))
+        if original is None:
+            return False
+        file.check_duplicate(original)
+        file.add_description('Identical to {}'.format(self._display_path(original)))
+        file.set_property('duplicate_of', original.get_property('filepath'))
+        if file.should_copy:
+            if self.scan_only:
+                pass
+            elif file.is_dangerous and not original.is_dangerous:
+                # Dangerous because of its name: keep the file as it is
+                file.safe_copy()
+                file.set_property('copied', True)
+            else:
+                file.copy_duplicate(original)
+                file.set_property('copied', True)
+            file.write_log()
+        return True
+
+    def _display_path(self, file):
+        """Path of `file` relative to the source root, through archives if needed."""
+        src_path = file.get_property('filepath')
+        if src_path.startswith(self.src_root_path + os.sep):
+            return os.path.relpath(src_path, self.src_root_path)
+        # Archive member: its destination directory mirrors the archive path
+        dst_dir = os.path.dirname(file.dst_path)
+        return os.path.join(os.path.relpath(dst_dir, self.output_root_path),
+                            file.get_property('filename'))
+
+    def process_archive(self, file, depth=0):
         """
         Unpack an archive using 7zip and process contents using process_dir.
 
         Should be given a Kittengroomer file object whose src_path points
-        to an archive.
+        to an archive, in `depth` other archives. With several workers, the
+        members are processed in parallel.
         """
-        self.recursive_archive_depth += 1
-        if self.recursive_archive_depth >= self.max_recursive_depth:
+        if depth + 1 >= self.max_recursive_depth:
             file.make_dangerous('Archive bomb')
         else:
             tempdir_path = file.make_tempdir()
@@ -638,17 +1878,26 @@ class KittenGroomerFileCheck(KittenGroomerBase):
             # otherwise we are running unsanitized user input directly in the shell
             command_str = '{} -p1 x "{}" -o"{}" -bd -aoa'
             unpack_command = command_str.format(SEVENZ_PATH,
-                                                file.src_path, tempdir_path)
-            self._run_process(unpack_command)
+                                                file.local_src_path(), tempdir_path)
+            time_left = self._time_left()
+            if not self._run_process(unpack_command, timeout=time_left) and time_left is not None \
+                    and self._time_left() <= 0:
+                # 7z was stopped at the end of the time budget
+                file.make_dangerous('Not fully extracted: out of time')
+                self.skipped.append(self._display_path(file))
             file.write_log()
-            self.process_dir(tempdir_path, file.dst_path)
-            self.safe_rmtree(tempdir_path)
-        self.recursive_archive_depth -= 1
+            file.logger.add_archive_dir(tempdir_path, file.get_property('filepath'))
+            self.process_dir(tempdir_path, file.dst_path, file.logger, depth + 1)
+            file.remove_tempdir()
 
     def _run_process(self, command_string, timeout=None):
         """Run command_string in a subprocess, wait until it finishes."""
         args = shlex.split(command_string)
+        request = self._request
         with open(self.logger.log_debug_err, 'ab') as stderr, open(self.logger.log_debug_out, 'ab') as stdout:
+            if request is not None and request.run_process is not None:
+                # Run where the request can kill it on cancellation
+                return request.run_process(args, stdout, stderr, timeout)
             try:
                 subprocess.check_call(args, stdout=stdout, stderr=stderr, timeout=timeout)
             except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
@@ -667,16 +1916,553 @@ class KittenGroomerFileCheck(KittenGroomerBase):
         return queue
 
     def run(self):
-        self.process_dir(self.src_root_path, self.dst_root_path)
+        """Process the source directory and return once the output is durable."""
+        try:
+            for result in self.iter_process():
+                pass
+        except InsufficientSpace:
+            # Raised before any file is processed: nothing to log nor write
+            self._remove_scratch()
+            raise
+        except BaseException:
+            # Log and write the files done so far
+            self.finish()
+            raise
+        self.finish()
+
+    def iter_process(self, paths=None):
+        """
+        Process files, yielding a FileResult for each one once it is done.
+
+        `paths` are files and directories in the source directory to process,
+        by default the whole source directory. Archive members are yielded
+        too. Files are processed in a background thread (and self.workers
+        threads in total) while results are consumed; the results are ready
+        to use, but the outputs are only guaranteed to be on the destination
+        once finish() is called, which logs the writes that failed. Stopping the iteration early stops the
+        processing after the files in progress.
+        """
+        if paths is None:
+            entries = self.list_files_dirs(self.src_root_path)
+        else:
+            entries = []
+            for path in paths:
+                path = self._source_path(path)
+                entries.append(path)
+                if os.path.isdir(path):
+                    entries += self.list_files_dirs(path)
+        if self.progress is not None:
+            self.progress.start()
+            self._index_source(entries)
+        if self.capacity_policy is not None and not self.scan_only:
+            self._plan_capacity(entries)
+        if self.time_budget is not None:
+            self._deadline = time.monotonic() + self.time_budget
+        # At most one result per worker waits, so that stopping the iteration stops the processing
+        results = self._results = queue.Queue(self.workers)
+        done = object()
+        errors = []
+
+        def produce():
+            try:
+                if self.workers > 1:
+                    # The producer thread is one of the workers
+                    with concurrent.futures.ThreadPoolExecutor(self.workers - 1) as executor:
+                        self._executor = executor
+                        self._process_entries(entries, self.output_root_path)
+                else:
+                    self._process_entries(entries, self.output_root_path)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                self._executor = None
+                results.put(done)
+
+        producer = threading.Thread(target=produce, name='circlean-producer', daemon=True)
+        producer.start()
+        try:
+            for result in iter(results.get, done):
+                yield result
+        finally:
+            self._stop.set()
+            # Unblock the workers until the producer is done
+            while producer.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+            self._results = None
+            self._stop.clear()
+        if errors:
+            raise errors[0]
+
+    def process_buffer(self, data, filename):
+        """
+        Process an in-memory file, return the FileResults of it and its archive members.
+
+        `data` is bytes, a memoryview or a file object (see as_buffer) and
+        `filename` its name in the source directory. The outputs go through
+        self.writer: with a MemoryWriter, they can be read back by the
+        dst_path of the results. Call finish() once done with the groomer.
+        """
+        return self._process_request(self._buffer_file, (data, filename))
+
+    def _buffer_file(self, data, filename):
+        filename = self._buffer_name(filename)
+        return self._make_file(os.path.join(self.src_root_path, filename),
+                               os.path.join(self.output_root_path, filename),
+                               self.logger, src_data=data)
+
+    def _buffer_name(self, filename):
+        """Return the normalized `filename`, raise ValueError if it isn't a relative path in the output directory."""
+        if not filename or os.path.isabs(filename):
+            raise ValueError('Invalid file name: {!r}'.format(filename))
+        parts = filename.split(os.sep)
+        if os.altsep:
+            parts = [part for name in parts for part in name.split(os.altsep)]
+        if os.pardir in parts:
+            raise ValueError('Invalid file name: {!r}'.format(filename))
+        filename = os.path.normpath(filename)
+        dst_path = os.path.abspath(os.path.join(self.output_root_path, filename))
+        if not dst_path.startswith(self.output_root_path + os.sep):
+            raise ValueError('{} is not in {}'.format(dst_path, self.output_root_path))
+        return filename
+
+    def _source_path(self, path):
+        """Return the absolute `path`, raise ValueError if it isn't in the source directory."""
+        path = os.path.abspath(path)
+        if not path.startswith(self.src_root_path + os.sep):
+            raise ValueError('{} is not in {}'.format(path, self.src_root_path))
+        return path
+
+    def _source_file(self, path):
+        path = self._source_path(path)
+        return self._make_file(path, os.path.join(self.output_root_path, os.path.basename(path)),
+                               self.logger)
+
+    def _process_request(self, make_file, args, request=None):
+        """Process the file made by make_file(*args) in this thread, return its FileResults."""
+        if request is None:
+            request = GroomRequest()
+        self._local.request = request
+        try:
+            self._process_task(make_file(*args), 0)
+        finally:
+            self._local.request = None
+        return request.results
+
+    def finish(self):
+        """
+        Write the logs (and report), return once the output is durable.
+
+        Call once all files are processed, run() does. Writes to the
+        destination that failed are logged with the file they belong to,
+        KittenGroomerError is raised for those that don't belong to a file.
+        """
+        self._remove_scratch()
+        if self.scan_only:
+            self._write_report()
+        if self.profiler is not None:
+            self.profiler.close()
+            self.profile_path = self._write_log_dir_file('circlean_profile.txt', self.profiler.report())
+        summary = self.results.summary_lines()
+        if self.skipped:
+            summary.append('   Not checked (out of time): {} files'.format(len(self.skipped)))
+        if self.not_copied:
+            summary.append('   Not copied (not enough space): {} files'.format(len(self.not_copied)))
+        write_errors = {}
+        if self.writer is not None:
+            # Queued writes fail after their file was logged: add their
+            # errors to the log entries of the files
+            self.writer.flush()
+            write_errors = dict(self.writer.failed)
+        if write_errors:
+            summary.append('   Not written to the destination: {} files'.format(len(write_errors)))
+        self.logger.finish(summary, write_errors)
+        if self.writer is not None:
+            self.writer.close()
+        self.scheduler.save()
+        if self.progress is not None:
+            self.progress.finish()
+        if self.writer is not None and self.writer.errors:
+            # Not attached to any file, e.g. the logs themselves
+            raise KittenGroomerError('Failed to write to the destination: {}'.format(
+                '; '.join(str(error) for error in self.writer.errors)))
+
+    def _remove_scratch(self):
+        self.scratch.close()
+        if self.scan_only:
+            self.safe_rmtree(self.output_root_path)
+
+    def _plan_capacity(self, entries):
+        """Choose the files of `entries` not to copy, raise InsufficientSpace (see CapacityPlanner)."""
+        planner = CapacityPlanner(self.dst_root_path)
+        for srcpath in entries:
+            if os.path.isdir(srcpath):
+                continue
+            # From the extension: libmagic only runs once, when the file is processed
+            mimetype = File.guess_mimetype(srcpath)
+            try:
+                size = os.path.getsize(srcpath)
+            except OSError:
+                size = 0
+            planner.add(srcpath, size, File.handler_for(mimetype), mimetype in Config.mimes_metadata)
+        self.not_copied = planner.plan(self.capacity_policy)
+
+    def _index_source(self, entries):
+        """Give the progress tracker the number and size of the files in `entries`."""
+        for srcpath in entries:
+            if not os.path.isdir(srcpath):
+                self.progress.add_discovered(os.path.getsize(srcpath))
+
+    def _write_report(self):
+        """Write the scan-only report as JSON next to the log."""
+        entries = []
+        for path, result in sorted(self.report, key=lambda entry: entry[0]):
+            props = result.get_all_props()
+            entries.append({
+                'path': path,
+                'size': props['file_size'],
+                'mimetype': result.mimetype,
+                'safety_category': props['safety_category'] or 'normal',
+                'descriptions': props['description_string'],
+                'errors': [str(error) for error in props['errors']],
+                'would_copy': result.should_copy,
+            })
+        report = {'source': self.src_root_path, 'files': entries}
+        self.report_path = self._write_log_dir_file('circlean_report.json', json.dumps(report, indent=2))
+
+    def _write_log_dir_file(self, name, data):
+        """Write `data` to the file `name` next to the log, return its path."""
+        path = os.path.join(os.path.dirname(self.logger.log_path), name)
+        if self.writer is not None:
+            self.writer.write(path, data)
+        else:
+            with open(path, 'w') as f:
+                f.write(data)
+        return path
+
+
+def warm_up():
+    """
+    Load everything a groomer needs before it touches the first file.
+
+    Imports the analysis dependencies that are otherwise imported lazily by
+    the handlers. Meant to be called once in a long-running process (see
+    GroomerDaemon) before forking, so that the workers inherit a warm
+    interpreter. Raises ImportError if a dependency is missing.
+    """
+    for module_name in ANALYSIS_MODULES:
+        importlib.import_module(module_name)
+    # Loads the libmagic database into the shared Magic instance
+    magic.from_buffer(b'', mime=True)
+    # Reads the system mime.types files
+    mimetypes.init()
+
+
+class GroomerDaemon(object):
+    """
+    Long-running groomer that forks a pre-warmed worker for each job.
+
+    Jobs are JSON objects of the form {"source": ..., "destination": ...}.
+    They are read from `*.job` files dropped in `spool_dir` and/or from
+    lines sent to the Unix socket at `socket_path`. Socket clients get a
+    JSON status line back once their job is finished. Jobs run as the user
+    of the daemon: the socket is only accessible as allowed by
+    `socket_mode`, to its owner by default. `groomer_options` are passed as
+    keyword arguments to `groomer_class` for every job.
+    """
+
+    # Seconds a client has to send its job line, and its maximum length
+    job_read_timeout = 5
+    max_job_line = 64 * 1024
+
+    def __init__(self, groomer_class, spool_dir=None, socket_path=None,
+                 max_workers=1, poll_interval=0.2, groomer_options=None, socket_mode=0o600):
+        if spool_dir is None and socket_path is None:
+            raise ValueError('GroomerDaemon needs a spool directory or a socket path')
+        self.groomer_class = groomer_class
+        self.spool_dir = spool_dir
+        self.socket_path = socket_path
+        self.socket_mode = socket_mode
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.groomer_options = groomer_options or {}
+        self.workers = {}  # pid: (job, job file path or None)
+        self._queue = []
+        self._sock = None
+        self._clients = {}  # Connection: (job line read so far, deadline)
+        self._running = False
+
+    def serve_forever(self):
+        """Warm up, then accept and run jobs until stop() is called."""
+        warm_up()
+        self._open_socket()
+        self._running = True
+        try:
+            while self._running:
+                self.handle_pending(timeout=self.poll_interval)
+        finally:
+            self.join()
+            self._close_socket()
+
+    def stop(self):
+        self._running = False
+
+    def handle_pending(self, timeout=0):
+        """Collect new jobs, reap finished workers and start queued jobs."""
+        self._accept_connections(timeout)
+        self._scan_spool_dir()
+        self._reap_workers()
+        while self._queue and len(self.workers) < self.max_workers:
+            self._start_worker(*self._queue.pop(0))
+
+    def join(self):
+        """Run every queued job and wait for all the workers to finish."""
+        while self._queue or self.workers:
+            self.handle_pending()
+            if self.workers:
+                self._reap_workers(block=True)
+
+    def _open_socket(self):
+        if self.socket_path is None:
+            return
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # No other user may connect between bind() and chmod()
+        umask = os.umask(0o177)
+        try:
+            self._sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, self.socket_mode)
+        self._sock.listen(16)
+
+    def _close_socket(self):
+        for conn in list(self._clients):
+            self._drop_client(conn, 'Daemon stopped')
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            os.remove(self.socket_path)
+
+    def _accept_connections(self, timeout):
+        """Accept new clients and read their job lines, without waiting on any of them."""
+        if self._sock is None:
+            if timeout:
+                time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self._sock] + list(self._clients), [], [], timeout)
+        for conn in readable:
+            if conn is self._sock:
+                conn, _ = self._sock.accept()
+                conn.setblocking(False)
+                self._clients[conn] = (b'', time.monotonic() + self.job_read_timeout)
+            else:
+                self._read_client(conn)
+        now = time.monotonic()
+        for conn, (data, deadline) in list(self._clients.items()):
+            if now > deadline:
+                self._drop_client(conn, 'No job received')
+
+    def _read_client(self, conn):
+        data, deadline = self._clients[conn]
+        try:
+            chunk = conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._drop_client(conn, str(e))
+            return
+        data += chunk
+        if b'\n' not in data and chunk and len(data) <= self.max_job_line:
+            self._clients[conn] = (data, deadline)
+            return
+        del self._clients[conn]
+        conn.setblocking(True)
+        try:
+            job = json.loads(data.split(b'\n', 1)[0].decode('utf-8'))
+        except ValueError as e:
+            self._send_status(conn, {'status': 'error', 'error': str(e)})
+            conn.close()
+            return
+        self._queue.append((job, conn))
+
+    def _drop_client(self, conn, error):
+        del self._clients[conn]
+        conn.setblocking(True)
+        self._send_status(conn, {'status': 'error', 'error': error})
+        conn.close()
+
+    def _scan_spool_dir(self):
+        if self.spool_dir is None:
+            return
+        for filename in sorted(os.listdir(self.spool_dir)):
+            if not filename.endswith('.job'):
+                continue
+            job_path = os.path.join(self.spool_dir, filename)
+            running_path = job_path + '.running'
+            try:
+                # Claim the job atomically
+                os.rename(job_path, running_path)
+                with open(running_path) as job_file:
+                    job = json.load(job_file)
+            except (ValueError, OSError):
+                if os.path.exists(running_path):
+                    os.rename(running_path, job_path + '.failed')
+                continue
+            self._queue.append((job, running_path))
+
+    def _start_worker(self, job, origin):
+        pid = os.fork()
+        if pid == 0:
+            if self._sock is not None:
+                self._sock.close()
+            for conn in self._clients:
+                conn.close()
+            returncode = 1
+            try:
+                groomer = self.groomer_class(job['source'], job['destination'],
+                                             **self.groomer_options)
+                groomer.run()
+                returncode = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                if isinstance(origin, socket.socket):
+                    self._send_status(origin, {'status': 'done' if returncode == 0 else 'failed',
+                                               'source': job.get('source'),
+                                               'destination': job.get('destination')})
+                os._exit(returncode)
+        self.workers[pid] = (job, origin)
+        if isinstance(origin, socket.socket):
+            # The worker owns the connection now
+            origin.close()
+
+    def _reap_workers(self, block=False):
+        if block:
+            pid, status = os.waitpid(-1, 0)
+            if pid in self.workers:
+                self._worker_done(pid, status)
+        for pid in list(self.workers):
+            reaped_pid, status = os.waitpid(pid, os.WNOHANG)
+            if reaped_pid:
+                self._worker_done(pid, status)
+
+    def _worker_done(self, pid, status):
+        job, origin = self.workers.pop(pid)
+        if isinstance(origin, str):
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                os.remove(origin)
+            else:
+                os.rename(origin, origin[:-len('.running')] + '.failed')
+
+    def _send_status(self, conn, status):
+        try:
+            conn.sendall(bytes(json.dumps(status) + '\n', 'utf-8'))
+        except OSError:
+            pass
+
+
+def submit_job(socket_path, source, destination):
+    """Send a job to a GroomerDaemon socket and wait for its status."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        job = {'source': source, 'destination': destination}
+        sock.sendall(bytes(json.dumps(job) + '\n', 'utf-8'))
+        return json.loads(sock.makefile('r').readline())
 
 
 def main(kg_implementation, description):
     parser = argparse.ArgumentParser(prog='KittenGroomer', description=description)
     parser.add_argument('-s', '--source', type=str, help='Source directory')
     parser.add_argument('-d', '--destination', type=str, help='Destination directory')
+    parser.add_argument('--spool', type=str,
+                        help='Run as a daemon, taking jobs from *.job files in this directory')
+    parser.add_argument('--socket', type=str,
+                        help='Run as a daemon, taking jobs from this Unix socket')
+    parser.add_argument('--socket-mode', type=lambda mode: int(mode, 8), default=0o600,
+                        help='Permissions of the daemon socket, in octal (default: 600, owner only)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Maximum number of jobs run at the same time in daemon mode')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Only analyse the first of several identical files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of files processed in parallel')
+    parser.add_argument('--cost-stats', type=str,
+                        help='File keeping per-handler processing time statistics between runs')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show the progress of the run on stderr')
+    parser.add_argument('--full-diagnostics', action='store_true',
+                        help='Keep checking files already found dangerous, to log every reason')
+    parser.add_argument('--scan-only', action='store_true',
+                        help='Only check the files: write the log and a JSON report to the destination, copy nothing')
+    parser.add_argument('--no-structured-log', action='store_true',
+                        help='Do not write the JSONL log (circlean_log.jsonl) and its index')
+    parser.add_argument('--scratch', type=str,
+                        help='Local directory for intermediate files (default: system temporary directory)')
+    parser.add_argument('--scratch-budget', type=int,
+                        help='Maximum size of the intermediate files in the scratch directory, in MB')
+    parser.add_argument('--archive', choices=ArchiveWriter.formats,
+                        help='Write the output as a single uncompressed archive of this format')
+    parser.add_argument('--time-budget', type=float,
+                        help='Seconds the processing may take: files that would not be checked in time are logged but not copied')
+    parser.add_argument('--capacity-policy', choices=CapacityPlanner.policies,
+                        help='Estimate the size of the output first. If it does not fit on the destination, '
+                             'abort, or copy the files that fit in source order or smallest first')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the checks of every file, write a report next to the log')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Record the peak memory of the checks of every file (see --profile)')
+    parser.add_argument('--profile-count', type=int, default=10,
+                        help='Number of files listed in each part of the profiling report (default: 10)')
     args = parser.parse_args()
-    kg = kg_implementation(args.source, args.destination)
-    kg.run()
+    groomer_options = {}
+    if args.dedup:
+        groomer_options['dedup'] = True
+    if args.jobs > 1:
+        groomer_options['workers'] = args.jobs
+    if args.cost_stats:
+        groomer_options['cost_stats_path'] = args.cost_stats
+    if args.scan_only:
+        groomer_options['scan_only'] = True
+    if args.full_diagnostics:
+        groomer_options['full_diagnostics'] = True
+    if args.progress:
+        groomer_options['progress_callback'] = print_progress
+    if args.no_structured_log:
+        groomer_options['structured_log'] = False
+    if args.scratch:
+        groomer_options['scratch_path'] = args.scratch
+    if args.scratch_budget is not None:
+        groomer_options['scratch_budget'] = args.scratch_budget * 1024 ** 2
+    if args.archive:
+        groomer_options['archive_format'] = args.archive
+    if args.time_budget is not None:
+        groomer_options['time_budget'] = args.time_budget
+    if args.capacity_policy:
+        groomer_options['capacity_policy'] = args.capacity_policy
+    if args.profile:
+        groomer_options['profile'] = True
+    if args.trace_memory:
+        groomer_options['trace_memory'] = True
+    if args.profile_count != 10:
+        groomer_options['profile_count'] = args.profile_count
+    if args.spool or args.socket:
+        daemon = GroomerDaemon(kg_implementation, args.spool, args.socket, args.workers,
+                               groomer_options=groomer_options, socket_mode=args.socket_mode)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    kg = kg_implementation(args.source, args.destination, **groomer_options)
+    try:
+        kg.run()
+    except InsufficientSpace as e:
+        sys.exit(e.message)
 
 
 if __name__ == '__main__':
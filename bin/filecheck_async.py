@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+asyncio interface of filecheck.py, for async services (Python 3.6+).
+
+Separate from filecheck.py, so that running the sanitizer neither imports
+asyncio, which is slow to import, nor needs a Python parsing coroutines.
+"""
+import os
+import asyncio
+import functools
+import concurrent.futures
+
+from bin.filecheck import GroomRequest
+
+
+def _run_process(request, args, stdout, stderr, timeout):
+    """Run a subprocess of `request` in its event loop, wait from the calling thread."""
+    future = asyncio.run_coroutine_threadsafe(
+        _run_process_async(request, args, stdout, stderr, timeout), request.loop)
+    try:
+        return future.result()
+    except concurrent.futures.CancelledError:
+        return
+
+
+async def _run_process_async(request, args, stdout, stderr, timeout):
+    if request.cancelled.is_set():
+        return
+    process = await asyncio.create_subprocess_exec(*args, stdout=stdout, stderr=stderr)
+    request.processes.add(process)
+    try:
+        if request.cancelled.is_set():
+            process.kill()
+        returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        return
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    finally:
+        request.processes.discard(process)
+    if returncode == 0:
+        return True
+
+
+class AsyncGroomer(object):
+    """
+    asyncio interface of a KittenGroomerFileCheck, for async services.
+
+    The checks run in `executor` (by default a pool of `concurrency`
+    threads), with at most `concurrency` files in progress, and 7z runs as an
+    asyncio subprocess. When a call is cancelled or runs out of its
+    `timeout` (in seconds), its running subprocesses are killed, archive
+    members not started yet are skipped and a file whose checks were cut
+    short is marked dangerous. Handlers already running can't be
+    interrupted: they finish in the background.
+    """
+
+    def __init__(self, groomer, executor=None, concurrency=4):
+        self.groomer = groomer
+        self.concurrency = concurrency
+        self._own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self.executor = executor
+        self._semaphore = None  # Made in the running loop, on first use
+
+    async def process_file(self, path, timeout=None):
+        """Process the file at `path` in the source directory, return the FileResults of it and its archive members."""
+        return await self._process(self.groomer._source_file, (path,), timeout)
+
+    async def process_buffer(self, data, filename, timeout=None):
+        """Like process_file, for an in-memory file (see KittenGroomerFileCheck.process_buffer)."""
+        return await self._process(self.groomer._buffer_file, (data, filename), timeout)
+
+    async def _process(self, make_file, args, timeout):
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        request = GroomRequest(loop)
+        request.run_process = functools.partial(_run_process, request)
+        async with self._semaphore:
+            future = loop.run_in_executor(self.executor, self.groomer._process_request,
+                                          make_file, args, request)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                request.cancel()
+                raise
+
+    async def iter_dir(self, path=None, timeout=None):
+        """
+        Process the files of a directory of the source, yielding FileResults as they are done.
+
+        `path` defaults to the whole source directory and `timeout` applies
+        to each file. Files are started as results are consumed, so that at
+        most `concurrency` files wait to be consumed. An error (or timeout)
+        cancels the files in progress and is raised.
+        """
+        groomer = self.groomer
+        path = groomer.src_root_path if path is None else groomer._source_path(path)
+        loop = asyncio.get_event_loop()
+        entries = await loop.run_in_executor(self.executor, groomer.list_files_dirs, path)
+        pending = set()
+        try:
+            for entry in entries:
+                if os.path.isdir(entry):
+                    groomer.logger.add_dir(entry)
+                    continue
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        for result in task.result():
+                            yield result
+                pending.add(asyncio.ensure_future(self.process_file(entry, timeout)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for result in task.result():
+                        yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def finish(self):
+        """Write the logs of the groomer, return once the output is durable."""
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.groomer.finish)
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
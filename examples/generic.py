@@ -3,8 +3,15 @@
 import os
 import mimetypes
 import shlex
+import select
+import shutil
+import signal
+import socket
 import subprocess
+import tempfile
 import time
+import queue
+import concurrent.futures
 
 from kittengroomer import FileBase, KittenGroomerBase, main
 
@@ -13,6 +20,19 @@ LIBREOFFICE = '/usr/bin/libreoffice'
 GS = '/usr/bin/gs'
 PDF2HTMLEX = '/usr/bin/pdf2htmlEX'
 SEVENZ = '/usr/bin/7z'
+QPDF = '/usr/bin/qpdf'  # Optional, needed to split big PDFs (see PDFA_SPLIT_PAGES)
+
+# LibreOffice listeners used for the conversions: number, first port, and how
+# long (in seconds) one may take to start and to convert a document
+CONVERTERS = 2
+CONVERTER_BASE_PORT = 2002
+CONVERTER_STARTUP_TIMEOUT = 60
+CONVERSION_TIMEOUT = 120
+
+# PDFs of more than this many pages are normalized in ranges of that many
+# pages, converted in parallel, if qpdf is installed to merge them. 0 disables
+# it: measure the gain on your hardware first (benchmarks/bench_pdfa.py)
+PDFA_SPLIT_PAGES = 0
 
 
 # Prepare application/<subtype>
@@ -46,6 +66,8 @@ class File(FileBase):
         super(File, self).__init__(src_path, dst_path)
 
         self.is_recursive = False
+        # Converted in the background: logged once the conversion is done
+        self.pending_conversion = False
         if not self.has_mimetype():
             # No mimetype, should not happen.
             self.make_dangerous()
@@ -89,9 +111,235 @@ class File(FileBase):
             pass
 
 
+class ConverterError(Exception):
+    pass
+
+
+def wait_process(process, timeout=None):
+    '''
+        Wait at most timeout seconds for process to exit, return its exit code or None.
+
+        Sleeps until the exit (pidfd on Linux) instead of polling, so that
+        short conversions don't wait for a poll interval.
+    '''
+    if timeout is None:
+        return process.wait()
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            # Already reaped, or the kernel is too old
+            pass
+    if pidfd is None:
+        try:
+            return process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            return None
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if not poller.poll(max(timeout, 0) * 1000):
+            return None
+    finally:
+        os.close(pidfd)
+    return process.wait()
+
+
+def run_process(args, log_out=os.devnull, log_err=os.devnull, timeout=None, cwd=None):
+    '''Run args in a subprocess, return its exit code, or None if it was killed at the timeout'''
+    with open(log_err, 'ab') as stderr, open(log_out, 'ab') as stdout:
+        process = subprocess.Popen(args, stdout=stdout, stderr=stderr, cwd=cwd)
+    code = wait_process(process, timeout)
+    if code is None:
+        process.kill()
+        process.wait()
+    return code
+
+
+class Converter(object):
+    '''A persistent LibreOffice listener, with its own port and profile, used through unoconv'''
+
+    def __init__(self, port, profile_dir, log_out=os.devnull, log_err=os.devnull):
+        self.port = port
+        self.profile_dir = profile_dir
+        self.log_out = log_out
+        self.log_err = log_err
+        self.process = None
+
+    def start(self):
+        '''Start the listener, call wait_ready() before using it'''
+        args = [UNOCONV, '--listener', '--port', str(self.port),
+                '--user-profile', self.profile_dir]
+        with open(self.log_err, 'ab') as stderr, open(self.log_out, 'ab') as stdout:
+            # In its own process group, with the soffice started by unoconv, to stop them together
+            self.process = subprocess.Popen(args, stdout=stdout, stderr=stderr, start_new_session=True)
+
+    def wait_ready(self, timeout=CONVERTER_STARTUP_TIMEOUT):
+        '''Wait until the listener accepts connections'''
+        deadline = time.time() + timeout
+        while True:
+            if not self.is_alive():
+                raise ConverterError('Listener on port {} exited'.format(self.port))
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.time() > deadline:
+                    raise ConverterError('Listener on port {} is not ready after {}s'.format(
+                        self.port, timeout))
+                time.sleep(0.1)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        '''Kill the listener and its soffice, which would keep the port and the profile lock'''
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+        self.wait_ready()
+
+    def convert(self, src_path, dst_path, timeout=CONVERSION_TIMEOUT):
+        '''Convert the document at src_path to PDF at dst_path, return False if it failed'''
+        # --no-launch: never fall back to starting another LibreOffice
+        args = [UNOCONV, '--no-launch', '--port', str(self.port), '--format', 'pdf',
+                '-eSelectPdfVersion=1', '--output', dst_path, src_path]
+        code = run_process(args, self.log_out, self.log_err, timeout)
+        if code is None:
+            # The listener is likely stuck on the document
+            self.stop()
+            return False
+        return code == 0
+
+
+class ConverterPool(object):
+    '''
+        Several LibreOffice listeners converting documents in parallel.
+
+        convert() can be called from as many threads as there are listeners,
+        other callers wait for one to be free. Listeners that crashed or timed
+        out are restarted before being used again.
+    '''
+
+    def __init__(self, size=CONVERTERS, base_port=CONVERTER_BASE_PORT, timeout=CONVERSION_TIMEOUT,
+                 log_out=os.devnull, log_err=os.devnull):
+        self.size = size
+        self.timeout = timeout
+        self.profile_root = tempfile.mkdtemp(prefix='kittengroomer_lo_')
+        self.converters = [Converter(base_port + i, os.path.join(self.profile_root, str(i)),
+                                     log_out, log_err) for i in range(size)]
+        self._idle = queue.Queue()
+        try:
+            # Start them all before waiting: LibreOffice is slow to start
+            for converter in self.converters:
+                converter.start()
+            for converter in self.converters:
+                converter.wait_ready()
+                self._idle.put(converter)
+        except Exception:
+            self.close()
+            raise
+
+    def convert(self, src_path, dst_path):
+        '''Convert the document at src_path to PDF at dst_path, return False if it failed'''
+        converter = self._idle.get()
+        try:
+            if not converter.is_alive():
+                converter.restart()
+            return converter.convert(src_path, dst_path, self.timeout)
+        finally:
+            self._idle.put(converter)
+
+    def close(self):
+        for converter in self.converters:
+            converter.stop()
+        shutil.rmtree(self.profile_root, ignore_errors=True)
+
+
+class PdfaConverter(object):
+    '''
+        Normalize PDF and PostScript files to PDF/A with Ghostscript.
+
+        Ghostscript only gets absolute paths, and runs in resources_path
+        (without changing the working directory of this process), so that
+        several conversions can run at once. With qpdf, PDFs of more than
+        split_pages pages are converted in page ranges, `workers` at a time,
+        then merged into the first range, which keeps its PDF/A catalog.
+    '''
+
+    def __init__(self, resources_path, split_pages=PDFA_SPLIT_PAGES, workers=None,
+                 log_out=os.devnull, log_err=os.devnull):
+        self.resources_path = os.path.abspath(resources_path)
+        self.split_pages = split_pages
+        self.log_out = log_out
+        self.log_err = log_err
+        self._ranges = concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 2)
+
+    def convert(self, src_path, dst_path):
+        '''Convert src_path to PDF/A at dst_path, return False if it failed'''
+        # Only qpdf merges the ranges without losing PDF/A conformance
+        pages = self.page_count(src_path) if self.split_pages and os.path.exists(QPDF) else None
+        if pages is None or pages <= self.split_pages:
+            return self._gs(src_path, dst_path)
+        ranges = [(first, min(first + self.split_pages - 1, pages))
+                  for first in range(1, pages + 1, self.split_pages)]
+        parts = ['{}.{}-{}.pdf'.format(dst_path, first, last) for first, last in ranges]
+        try:
+            jobs = [self._ranges.submit(self._gs, src_path, part, first, last)
+                    for part, (first, last) in zip(parts, ranges)]
+            if not all([job.result() for job in jobs]):
+                return False
+            return self._merge(parts, dst_path)
+        finally:
+            for part in parts:
+                if os.path.exists(part):
+                    os.remove(part)
+
+    def page_count(self, path):
+        '''Return the number of pages of the PDF at path with qpdf, None if it can't be read'''
+        try:
+            output = subprocess.run([QPDF, '--show-npages', os.path.abspath(path)],
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    timeout=CONVERSION_TIMEOUT).stdout
+            return int(output.split()[-1])
+        except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+            return None
+
+    def close(self):
+        self._ranges.shutdown()
+
+    def _gs(self, src_path, dst_path, first_page=None, last_page=None):
+        # The magic comes from here: http://svn.ghostscript.com/ghostscript/trunk/gs/doc/Ps2pdf.htm#PDFA
+        args = [GS, '-dPDFA', '-dQUIET', '-dSAFER', '-dBATCH', '-dNOPAUSE', '-dNOOUTERSAVE',
+                '-sProcessColorModel=DeviceCMYK', '-sDEVICE=pdfwrite', '-sPDFACompatibilityPolicy=1']
+        if first_page is not None:
+            args += ['-dFirstPage={}'.format(first_page), '-dLastPage={}'.format(last_page)]
+        # % in the output file name would be a page number format
+        args += ['-sOutputFile=' + os.path.abspath(dst_path).replace('%', '%%'),
+                 os.path.join(self.resources_path, 'PDFA_def.ps'), os.path.abspath(src_path)]
+        # PDFA_def.ps refers to the ICC profile relatively to resources_path
+        return run_process(args, self.log_out, self.log_err, cwd=self.resources_path) == 0
+
+    def _merge(self, parts, dst_path):
+        # The first part is the base, not --empty: its catalog holds the
+        # OutputIntents and XMP metadata of the PDF/A. 3: succeeded with warnings
+        return run_process([QPDF, parts[0], '--pages'] + parts + ['--', dst_path],
+                           self.log_out, self.log_err) in (0, 3)
+
+
 class KittenGroomer(KittenGroomerBase):
 
-    def __init__(self, root_src=None, root_dst=None, max_recursive=2, debug=False):
+    def __init__(self, root_src=None, root_dst=None, max_recursive=2, debug=False,
+                 converters=CONVERTERS, workers=None):
         '''
             Initialize the basics of the conversion process
         '''
@@ -127,8 +375,15 @@ class KittenGroomer(KittenGroomerBase):
             'inode': self.inode,
         }
 
-        unoconv_listener = UNOCONV + ' --listener'
-        self._run_process(unoconv_listener, background=True)
+        # Started on the first document to convert, stopped at the end of processdir
+        self.converters = converters
+        self.converter_pool = None
+        self.pdfa_converter = None
+        # Conversions that don't depend on the next files run in the background,
+        # in up to `workers` threads
+        self.workers = workers or os.cpu_count() or 2
+        self._jobs = None
+        self._pending_jobs = []
 
     # ##### Helpers #####
     def _init_subtypes_application(self, subtypes_application):
@@ -141,40 +396,56 @@ class KittenGroomer(KittenGroomerBase):
                 to_return[st] = fct
         return to_return
 
-    def _print_log(self):
+    def _print_log(self, cur_file=None):
         '''
-            Print the logs related to the current file being processed
+            Print the logs related to the current file being processed (or to cur_file)
         '''
-        tmp_log = self.log_name.fields(**self.cur_file.log_details)
-        if self.cur_file.is_dangerous():
-            tmp_log.warning(self.cur_file.log_string)
-        elif self.cur_file.log_details.get('unknown') or self.cur_file.log_details.get('binary'):
-            tmp_log.info(self.cur_file.log_string)
+        if cur_file is None:
+            cur_file = self.cur_file
+        tmp_log = self.log_name.fields(**cur_file.log_details)
+        if cur_file.is_dangerous() or cur_file.log_details.get('converted') is False:
+            tmp_log.warning(cur_file.log_string)
+        elif cur_file.log_details.get('unknown') or cur_file.log_details.get('binary'):
+            tmp_log.info(cur_file.log_string)
         else:
-            tmp_log.debug(self.cur_file.log_string)
-
-    def _run_process(self, command_line, timeout=0, background=False):
-        '''Run subprocess, wait until it finishes'''
-        if timeout != 0:
-            deadline = time.time() + timeout
-        else:
-            deadline = None
-        args = shlex.split(command_line)
-        with open(self.log_debug_err, 'ab') as stderr, open(self.log_debug_out, 'ab') as stdout:
-            p = subprocess.Popen(args, stdout=stdout, stderr=stderr)
-        if background:
-            # FIXME: This timer is here to make sure the unoconv listener is properly started.
-            time.sleep(10)
-            return True
-        while True:
-            code = p.poll()
-            if code is not None:
-                break
-            if deadline is not None and time.time() > deadline:
-                p.kill()
-                break
-            time.sleep(1)
-        return True
+            tmp_log.debug(cur_file.log_string)
+
+    def _run_process(self, command_line, timeout=0):
+        '''Run subprocess, wait until it finishes, return True if it succeeded'''
+        code = run_process(shlex.split(command_line), self.log_debug_out, self.log_debug_err,
+                           timeout or None)
+        return code == 0
+
+    def _submit_job(self, function, *args):
+        '''Run function(*args) in the background, to convert the current file'''
+        if self._jobs is None:
+            self._jobs = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.cur_file.pending_conversion = True
+        self._pending_jobs.append((self.cur_file, self._jobs.submit(function, *args)))
+
+    def _wait_jobs(self):
+        '''Wait for the conversions running in the background, log their files with the outcome'''
+        jobs, self._pending_jobs = self._pending_jobs, []
+        for cur_file, job in jobs:
+            try:
+                job.result()
+                cur_file.add_log_details('converted', True)
+            except Exception as e:
+                cur_file.add_log_details('converted', False)
+                cur_file.add_log_details('conversion_error', str(e))
+            self._print_log(cur_file)
+
+    def _close_jobs(self):
+        self._wait_jobs()
+        if self._jobs is not None:
+            self._jobs.shutdown()
+            self._jobs = None
+        if self.converter_pool is not None:
+            self.converter_pool.close()
+            self.converter_pool = None
+        if self.pdfa_converter is not None:
+            self.pdfa_converter.close()
+            self.pdfa_converter = None
 
     #######################
 
@@ -233,38 +504,51 @@ class KittenGroomer(KittenGroomerBase):
     def _office_related(self):
         '''Way to process all the files LibreOffice can handle'''
         self.cur_file.add_log_details('processing_type', 'office')
-        dst_dir, filename = os.path.split(self.cur_file.dst_path)
-        tmpdir = os.path.join(dst_dir, 'temp')
-        name, ext = os.path.splitext(filename)
+        if self.converter_pool is None:
+            self.converter_pool = ConverterPool(self.converters, log_out=self.log_debug_out,
+                                                log_err=self.log_debug_err)
+        # Converted in parallel with the next files, each in its own temp dir
+        self._submit_job(self._convert_office, self.cur_file.src_path, self.cur_file.dst_path)
+
+    def _convert_office(self, src_path, dst_path):
+        '''Convert a document to PDF with the converter pool, then to HTML'''
+        # Intermediate files stay off the destination key
+        tmpdir = tempfile.mkdtemp(prefix='kittengroomer_')
+        name, ext = os.path.splitext(os.path.basename(dst_path))
         tmppath = os.path.join(tmpdir, name + '.pdf')
-        self._safe_mkdir(tmpdir)
-        lo_command = '{} --format pdf -eSelectPdfVersion=1 --output "{}" "{}"'.format(
-            UNOCONV, tmppath, self.cur_file.src_path)
-        self._run_process(lo_command)
-        self._pdfa(tmppath)
-        self._safe_rmtree(tmpdir)
-
-    def _pdfa(self, tmpsrcpath):
+        try:
+            if not self.converter_pool.convert(src_path, tmppath):
+                raise ConverterError('unoconv failed or timed out')
+            self._pdfa(tmppath, dst_path)
+        finally:
+            self._safe_rmtree(tmpdir)
+
+    def _pdfa(self, tmpsrcpath, dst_path):
         '''Way to process PDF/A file'''
-        pdf_command = '{} --dest-dir / "{}" "{}"'.format(PDF2HTMLEX, tmpsrcpath, self.cur_file.dst_path + '.html')
-        self._run_process(pdf_command)
+        pdf_command = '{} --dest-dir / "{}" "{}"'.format(PDF2HTMLEX, tmpsrcpath, dst_path + '.html')
+        if not self._run_process(pdf_command):
+            raise ConverterError('pdf2htmlEX failed')
 
     def _pdf(self):
         '''Way to process PDF file'''
         self.cur_file.add_log_details('processing_type', 'pdf')
-        dst_dir, filename = os.path.split(self.cur_file.dst_path)
-        tmpdir = os.path.join(dst_dir, 'temp')
-        tmppath = os.path.join(tmpdir, filename)
-        self._safe_mkdir(tmpdir)
-        # The magic comes from here: http://svn.ghostscript.com/ghostscript/trunk/gs/doc/Ps2pdf.htm#PDFA
-        curdir = os.getcwd()
-        os.chdir(self.resources_path)
-        gs_command = '{} -dPDFA -dQUIET -dSAFER -dBATCH -dNOPAUSE -dNOOUTERSAVE -sProcessColorModel=DeviceCMYK -sDEVICE=pdfwrite -sPDFACompatibilityPolicy=1 -sOutputFile="{}" ./PDFA_def.ps "{}"'.format(
-            GS, os.path.join(curdir, tmppath), os.path.join(curdir, self.cur_file.src_path))
-        self._run_process(gs_command)
-        os.chdir(curdir)
-        self._pdfa(tmppath)
-        self._safe_rmtree(tmpdir)
+        if self.pdfa_converter is None:
+            self.pdfa_converter = PdfaConverter(self.resources_path, workers=self.workers,
+                                                log_out=self.log_debug_out,
+                                                log_err=self.log_debug_err)
+        # Converted in parallel with the next files, each in its own temp dir
+        self._submit_job(self._convert_pdf, self.cur_file.src_path, self.cur_file.dst_path)
+
+    def _convert_pdf(self, src_path, dst_path):
+        '''Normalize a PDF to PDF/A with Ghostscript, then convert it to HTML'''
+        tmpdir = tempfile.mkdtemp(prefix='kittengroomer_')
+        tmppath = os.path.join(tmpdir, os.path.basename(dst_path))
+        try:
+            if not self.pdfa_converter.convert(src_path, tmppath):
+                raise ConverterError('Ghostscript failed')
+            self._pdfa(tmppath, dst_path)
+        finally:
+            self._safe_rmtree(tmpdir)
 
     def _archive(self):
         '''Way to process Archive'''
@@ -279,6 +563,8 @@ class KittenGroomer(KittenGroomerBase):
         self.tree(tmpdir)
         self.processdir(tmpdir, self.cur_file.dst_path)
         self.recursive -= 1
+        # The files of the archive are converted from tmpdir
+        self._wait_jobs()
         self._safe_rmtree(tmpdir)
 
     def _unknown_app(self):
@@ -348,8 +634,11 @@ class KittenGroomer(KittenGroomerBase):
                 self.mime_processing_options.get(self.cur_file.main_type, self.unknown)()
             else:
                 self._safe_copy()
-            if not self.cur_file.is_recursive:
+            if not self.cur_file.is_recursive and not self.cur_file.pending_conversion:
                 self._print_log()
 
+        if self.recursive == 0:
+            self._close_jobs()
+
 if __name__ == '__main__':
     main(KittenGroomer, 'Generic version of the KittenGroomer. Convert and rename files.')
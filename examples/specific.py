@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import os
+import stat
+import shutil
+import tempfile
 
 from kittengroomer import FileBase, KittenGroomerBase, main
 
@@ -8,6 +11,10 @@ from kittengroomer import FileBase, KittenGroomerBase, main
 # Extension
 configfiles = {'.conf': 'text/plain'}
 
+# Valid files are copied in a hidden directory of the destination until the
+# whole key is validated
+STAGING_PREFIX = '.kittengroomer_staging_'
+
 
 class FileSpec(FileBase):
 
@@ -51,49 +58,99 @@ class KittenGroomerSpec(KittenGroomerBase):
     def processdir(self):
         '''
             Main function doing the processing
+
+            Copies all the files, or none if one of them is not allowed. The
+            files are validated and copied to a staging directory in a single
+            pass, stopping at the first file not allowed. The staging directory
+            is then moved into place, or removed. Nothing is copied either if
+            its content can't replace what is already on the destination.
         '''
-        to_copy = []
-        error = []
-        for srcpath in self.list_all_files(self.src_root_dir):
-            valid = True
-            self.log_name.info('Processing {}', srcpath.replace(self.src_root_dir + '/', ''))
-            self.cur_file = FileSpec(srcpath, srcpath.replace(self.src_root_dir, self.dst_root_dir))
-            if self.cur_file.is_dangerous():
-                valid = False
-                error.append(self.cur_file)
-            else:
-                expected_mime = self.valid_files.get(self.cur_file.extension)
-                compare_ext = ''
-                compare_mime = ''
-                if expected_mime is None:
-                    # Unexpected extension => disallowed
-                    valid = False
-                    compare_ext = 'Extension: {} - Expected: {}'.format(self.cur_file.extension, ', '.join(self.valid_files.keys()))
-                elif self.cur_file.mimetype != expected_mime:
-                    # Unexpected mimetype => dissalowed
-                    valid = False
-                    compare_mime = 'Mime: {} - Expected: {}'.format(self.cur_file.mimetype, expected_mime)
-
-                if valid:
-                    to_copy.append(self.cur_file)
-                    self.cur_file.log_string = 'Extension: {} - MimeType: {}'.format(self.cur_file.extension, self.cur_file.mimetype)
-                else:
-                    error.append(self.cur_file)
-                    if compare_ext:
-                        self.cur_file.log_string = compare_ext
-                    else:
-                        self.cur_file.log_string = compare_mime
-            self.cur_file.add_log_details('valid', valid)
-
-        if len(error) > 0:
-            for f in error + to_copy:
-                self.cur_file = f
-                self._print_log()
+        self._remove_stale_staging()
+        staging_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.dst_root_dir)
+        try:
+            for srcpath in self.list_all_files(self.src_root_dir):
+                relpath = os.path.relpath(srcpath, self.src_root_dir)
+                self.log_name.info('Processing {}', relpath)
+                if not self._validate_and_stage(srcpath, os.path.join(staging_dir, relpath)):
+                    self.log_name.warning('Nothing copied: {} is not allowed', relpath)
+                    return False
+            conflicts = self._commit_conflicts(staging_dir)
+            if conflicts:
+                self.log_name.warning('Nothing copied: {} can not be replaced on the destination',
+                                      ', '.join(conflicts))
+                return False
+            self._commit_staging(staging_dir)
+            return True
+        finally:
+            self._safe_rmtree(staging_dir)
+
+    def _validate_and_stage(self, srcpath, dstpath):
+        '''Check the file at srcpath, copy it to dstpath if allowed, return False if not'''
+        _, extension = os.path.splitext(srcpath)
+        expected_mime = self.valid_files.get(extension.lower())
+        if expected_mime is None:
+            # Unexpected extension => disallowed, no need to read the file
+            self.log_name.warning('Extension: {} - Expected: {}', extension.lower() or None,
+                                  ', '.join(self.valid_files.keys()))
+            return False
+        self.cur_file = FileSpec(srcpath, dstpath)
+        valid = True
+        if self.cur_file.is_dangerous():
+            valid = False
+        elif self.cur_file.mimetype != expected_mime:
+            # Unexpected mimetype => dissalowed
+            valid = False
+            self.cur_file.log_string = 'Mime: {} - Expected: {}'.format(self.cur_file.mimetype, expected_mime)
         else:
-            for f in to_copy:
-                self.cur_file = f
-                self._safe_copy()
-                self._print_log()
+            self.cur_file.log_string = 'Extension: {} - MimeType: {}'.format(self.cur_file.extension, self.cur_file.mimetype)
+            self._safe_copy()
+        self.cur_file.add_log_details('valid', valid)
+        self._print_log()
+        return valid
+
+    def _commit_conflicts(self, staging_dir):
+        '''
+            Return the top level entries of staging_dir that os.replace can't move to the destination
+
+            A directory can only replace an empty directory, and a file only
+            a file. Checked before the first rename, so that the commit
+            doesn't stop half-way.
+        '''
+        conflicts = []
+        for name in sorted(os.listdir(staging_dir)):
+            target = os.path.join(self.dst_root_dir, name)
+            try:
+                target_mode = os.lstat(target).st_mode
+            except FileNotFoundError:
+                continue
+            if os.path.isdir(os.path.join(staging_dir, name)):
+                if not stat.S_ISDIR(target_mode) or os.listdir(target):
+                    conflicts.append(name)
+            elif stat.S_ISDIR(target_mode):
+                conflicts.append(name)
+        return conflicts
+
+    def _commit_staging(self, staging_dir):
+        '''
+            Move the content of staging_dir to the destination
+
+            The destination is usually a mount point, which can't be replaced:
+            each top level entry is renamed into place instead, on the same
+            filesystem, so that no file is ever seen partially copied.
+        '''
+        for name in os.listdir(staging_dir):
+            os.replace(os.path.join(staging_dir, name), os.path.join(self.dst_root_dir, name))
+        fd = os.open(self.dst_root_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _remove_stale_staging(self):
+        '''Remove the staging directories left by an interrupted run'''
+        for name in os.listdir(self.dst_root_dir):
+            if name.startswith(STAGING_PREFIX):
+                shutil.rmtree(os.path.join(self.dst_root_dir, name), ignore_errors=True)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .helpers import FileBase, KittenGroomerBase, Logging, main
+from .helpers import FileBase, FileResult, KittenGroomerBase, DestinationWriter, Logging, main
+from .helpers import KittenGroomerError
+from .helpers import ArchiveWriter, MemoryWriter, as_buffer
+from .helpers import Progress, ProgressTracker, print_progress
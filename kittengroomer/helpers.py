@@ -9,9 +9,18 @@ your desired behavior.
 
 
 import os
+import sys
+import time
 import hashlib
 import shutil
+import stat
 import argparse
+import threading
+import collections
+import io
+import mmap
+import zipfile
+import tarfile
 
 import magic
 
@@ -29,6 +38,31 @@ class ImplementationRequired(KittenGroomerError):
     pass
 
 
+# libmagic doesn't look further than this into a file
+MAGIC_BYTES = 1024 * 1024
+
+
+def as_buffer(source):
+    """
+    Return a memoryview of bytes over `source`.
+
+    `source` can be bytes, a bytearray, a memoryview, or a readable binary
+    file object. Files backed by a file descriptor are mmapped, others read.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return memoryview(source).cast('B')
+    try:
+        fileno = source.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    else:
+        if os.fstat(fileno).st_size:
+            return memoryview(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ))
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return memoryview(source.read())
+
+
 class FileBase(object):
     """
     Base object for individual files in the source directory.
@@ -36,14 +70,27 @@ class FileBase(object):
     Contains file attributes and various helper methods.
     """
 
-    def __init__(self, src_path, dst_path):
+    # Keeps the memory used per file low on large runs. Subclasses without
+    # __slots__ can still add any attribute.
+    __slots__ = ('src_path', 'src_data', 'dst_path', 'writer', 'filename', 'extension',
+                 'mimetype', 'should_copy', 'main_type', 'sub_type',
+                 'metadata_file_path', '_file_props')
+
+    def __init__(self, src_path, dst_path, writer=None, src_data=None):
         """
         Initialized with the source path and expected destination path.
 
-        Create various properties and determine the file's mimetype.
+        Create various properties and determine the file's mimetype. If a
+        DestinationWriter (or MemoryWriter) is passed as `writer`, writes to
+        the destination go through it instead of being performed
+        synchronously. If `src_data` (bytes, memoryview or a file object, see
+        as_buffer) is passed, it is the content of the file, which is never
+        read from `src_path`: `src_path` only names the file.
         """
         self.src_path = src_path
+        self.src_data = as_buffer(src_data) if src_data is not None else None
         self.dst_path = dst_path
+        self.writer = writer
         self.filename = os.path.basename(self.src_path)
         self._file_props = {
             'filepath': self.src_path,
@@ -56,8 +103,8 @@ class FileBase(object):
             'symlink': False,
             'copied': False,
             'description_string': [],  # array of descriptions to be joined
-            'errors': {},
-            'user_defined': {}
+            'errors': None,  # Made by add_error, or by get_all_props
+            'user_defined': None  # Made by set_property, or by get_all_props
         }
         self.extension = self._determine_extension()
         self.set_property('extension', self.extension)
@@ -66,6 +113,8 @@ class FileBase(object):
         self.main_type = None
         self.sub_type = None
         if self.mimetype:
+            # Interned: the same few mimetypes are shared by many files
+            self.mimetype = sys.intern(self.mimetype)
             self.main_type, self.sub_type = self._split_subtypes(self.mimetype)
             if self.main_type:
                 self.set_property('maintype', self.main_type)
@@ -77,9 +126,13 @@ class FileBase(object):
         ext = ext.lower()
         if ext == '':
             ext = None
+        else:
+            ext = sys.intern(ext)
         return ext
 
     def _determine_mimetype(self):
+        if self.src_data is not None:
+            return magic.from_buffer(bytes(self.src_data[:MAGIC_BYTES]), mime=True)
         if os.path.islink(self.src_path):
             # magic will throw an IOError on a broken symlink
             mimetype = 'inode/symlink'
@@ -101,7 +154,7 @@ class FileBase(object):
 
     def _split_subtypes(self, mimetype):
         if '/' in mimetype:
-            main_type, sub_type = mimetype.split('/')
+            main_type, sub_type = map(sys.intern, mimetype.split('/'))
         else:
             main_type, sub_type = None, None
         return main_type, sub_type
@@ -109,6 +162,8 @@ class FileBase(object):
     @property
     def size(self):
         """Filesize in bytes as an int, 0 if file does not exist."""
+        if self.src_data is not None:
+            return len(self.src_data)
         try:
             size = os.path.getsize(self.src_path)
         except FileNotFoundError:
@@ -167,6 +222,8 @@ class FileBase(object):
         elif prop_string in self._file_props.keys():
             self._file_props[prop_string] = value
         else:
+            if self._file_props['user_defined'] is None:
+                self._file_props['user_defined'] = {}
             self._file_props['user_defined'][prop_string] = value
 
     def get_property(self, prop_string):
@@ -175,19 +232,37 @@ class FileBase(object):
 
         Returns `None` if `prop_string` cannot be found on the file.
         """
+        if prop_string in ('errors', 'user_defined'):
+            return self.get_all_props()[prop_string]
         if prop_string in self._file_props:
             return self._file_props[prop_string]
-        elif prop_string in self._file_props['user_defined']:
-            return self._file_props['user_defined'][prop_string]
-        else:
-            return None
+        user_defined = self._file_props['user_defined']
+        if user_defined is not None and prop_string in user_defined:
+            return user_defined[prop_string]
+        return None
 
     def get_all_props(self):
         """Return a dict containing all stored properties of this file."""
-        return self._file_props
+        props = self._file_props
+        if props['errors'] is None:
+            props['errors'] = {}
+        if props['user_defined'] is None:
+            props['user_defined'] = {}
+        return props
+
+    def result(self, path=None):
+        """
+        Return a FileResult holding the final verdict on this file.
+
+        `path` is the path of the file to show to users, if different from
+        its source path.
+        """
+        return FileResult(self, path)
 
     def add_error(self, error, info_string):
         """Add an `error`: `info_string` pair to the file."""
+        if self._file_props['errors'] is None:
+            self._file_props['errors'] = {}
         self._file_props['errors'].update({error: info_string})
 
     def add_description(self, description_string):
@@ -231,10 +306,18 @@ class FileBase(object):
 
     def safe_copy(self, src=None, dst=None):
         """Copy file and create destination directories if needed."""
-        if src is None:
-            src = self.src_path
         if dst is None:
             dst = self.dst_path
+        if src is None:
+            if self.src_data is not None:
+                if self.writer is None and os.path.dirname(dst):
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                self.write_dst_file(dst, self.src_data)
+                return
+            src = self.src_path
+        if self.writer is not None:
+            self.writer.copy(src, dst, on_error=self._add_writer_error)
+            return
         try:
             dst_path, filename = os.path.split(dst)
             if not os.path.exists(dst_path):
@@ -243,6 +326,18 @@ class FileBase(object):
         except Exception as e:
             self.add_error(e, '')
 
+    def open_src(self):
+        """Return a binary file object reading the source, wherever it is."""
+        if self.src_data is not None:
+            return io.BytesIO(self.src_data)
+        return open(self.src_path, 'rb')
+
+    def compute_hash(self):
+        """Return the sha256 hash of the source."""
+        if self.src_data is not None:
+            return hashlib.sha256(self.src_data).hexdigest()
+        return Logging.computehash(self.src_path)
+
     def force_ext(self, ext):
         """If dst_path does not end in ext, append .ext to it."""
         ext = self._check_leading_dot(ext)
@@ -268,7 +363,9 @@ class FileBase(object):
                 raise KittenGroomerError(err_str)
             else:
                 dst_dir_path, filename = os.path.split(self.dst_path)
-                if not os.path.exists(dst_dir_path):
+                if self.writer is not None:
+                    self.writer.makedirs(dst_dir_path)
+                elif not os.path.exists(dst_dir_path):
                     os.makedirs(dst_dir_path)
                 self.metadata_file_path = self.dst_path + ext
                 return self.metadata_file_path
@@ -276,6 +373,26 @@ class FileBase(object):
             self.add_error(e, '')
             return False
 
+    def write_dst_file(self, dst, data):
+        """
+        Write `data` (str or bytes) to the file at `dst` on the destination.
+
+        Goes through the destination writer if there is one, otherwise
+        writes synchronously.
+        """
+        if self.writer is not None:
+            self.writer.write(dst, data, on_error=self._add_writer_error)
+            return
+        mode = 'w' if isinstance(data, str) else 'wb'
+        try:
+            with open(dst, mode) as f:
+                f.write(data)
+        except Exception as e:
+            self.add_error(e, '')
+
+    def _add_writer_error(self, error):
+        self.add_error(error, 'Error while writing to the destination')
+
     def _check_leading_dot(self, ext):
         if len(ext) > 0:
             if not ext.startswith('.'):
@@ -283,6 +400,68 @@ class FileBase(object):
         return ext
 
 
+class FileResult(object):
+    """
+    The final verdict on a processed file, built by FileBase.result().
+
+    Much smaller than a FileBase: keep these rather than the files to hold
+    the results of a large run in memory. Offers the read-only part of the
+    FileBase API.
+    """
+
+    __slots__ = ('path', 'extension', 'mimetype', 'dst_path', 'should_copy',
+                 'metadata_file_path', '_props')
+
+    # The values of these properties are stored in order in self._props
+    _prop_names = ('filepath', 'filename', 'file_size', 'maintype', 'subtype',
+                   'extension', 'safety_category', 'symlink', 'copied',
+                   'description_string', 'errors', 'user_defined')
+    _prop_index = {name: index for index, name in enumerate(_prop_names)}
+
+    def __init__(self, file, path=None):
+        self.path = path if path is not None else file.get_property('filepath')
+        self.extension = file.extension
+        self.mimetype = file.mimetype
+        self.dst_path = file.dst_path
+        self.should_copy = file.should_copy
+        self.metadata_file_path = getattr(file, 'metadata_file_path', None)
+        props = file.get_all_props()
+        values = [props[name] for name in self._prop_names]
+        values[self._prop_index['description_string']] = tuple(props['description_string'])
+        values[self._prop_index['errors']] = tuple(props['errors'].items()) or None
+        values[self._prop_index['user_defined']] = dict(props['user_defined']) or None
+        self._props = tuple(values)
+
+    @property
+    def is_dangerous(self):
+        return self.get_property('safety_category') == 'dangerous'
+
+    @property
+    def is_unknown(self):
+        return self.get_property('safety_category') == 'unknown'
+
+    @property
+    def is_binary(self):
+        return self.get_property('safety_category') == 'binary'
+
+    def get_property(self, prop_string):
+        """Same as FileBase.get_property."""
+        index = self._prop_index.get(prop_string)
+        if index is None:
+            return (self._props[-1] or {}).get(prop_string)
+        if prop_string in ('description_string', 'errors', 'user_defined'):
+            return self.get_all_props()[prop_string]
+        return self._props[index]
+
+    def get_all_props(self):
+        """Return a new dict with the properties, like FileBase.get_all_props."""
+        props = dict(zip(self._prop_names, self._props))
+        props['description_string'] = list(props['description_string'])
+        props['errors'] = dict(props['errors'] or ())
+        props['user_defined'] = props['user_defined'] or {}
+        return props
+
+
 class Logging(object):
 
     @staticmethod
@@ -298,6 +477,541 @@ class Logging(object):
         return s.hexdigest()
 
 
+class DestinationWriter(object):
+    """
+    Write-behind writer for the destination directory.
+
+    Copies and small writes are queued in memory and performed in order by a
+    background thread, so that slow destination media (cheap FAT32 USB keys)
+    don't stall processing. The queue is bounded by `max_queue_bytes`: callers
+    block while it is full, and files bigger than the cap are copied
+    synchronously. Directory creation is coalesced. Nothing is fsynced until
+    flush() is called, which makes everything written so far durable in one
+    batch. Call close() (or flush()) before relying on the destination.
+    """
+
+    def __init__(self, max_queue_bytes=32 * 1024 * 1024, checkpoint_bytes=None,
+                 durable=True):
+        """
+        `checkpoint_bytes`, if set, triggers a flush from the writer thread
+        each time that many bytes have been written since the last one.
+        `durable` can be set to False to skip the fsyncs entirely.
+        """
+        self.max_queue_bytes = max_queue_bytes
+        self.checkpoint_bytes = checkpoint_bytes
+        self.durable = durable
+        self.errors = []  # errors raised by ops that have no on_error callback (or by the callback)
+        # path: error of every write that failed. Queued writes fail after
+        # the caller moved on: check this once flushed.
+        self.failed = {}
+        self.bytes_written = 0
+        self._ops = collections.deque()
+        self._cond = threading.Condition()
+        self._queued_bytes = 0
+        self._pending = 0  # ops queued or running
+        self._thread = None
+        self._dirs_lock = threading.Lock()
+        self._created_dirs = set()
+        self._dirty_files = set()
+        self._dirty_dirs = set()
+        self._bytes_since_sync = 0
+
+    def copy(self, src, dst, on_error=None):
+        """Copy the file at `src` to `dst`, creating directories if needed."""
+        try:
+            size = os.path.getsize(src)
+            if size > self.max_queue_bytes:
+                # Too big to buffer: copy now, but still defer the fsync
+                self._copy_now(src, dst, size)
+                return
+            # Read now so the source (possibly a temp file) can go away
+            mode = os.stat(src).st_mode
+            with open(src, 'rb') as f:
+                data = f.read()
+        except Exception as e:
+            self._report(e, on_error, dst)
+            return
+        self._put(('write', dst, data, mode, on_error), len(data))
+
+    def duplicate(self, existing, dst, on_error=None):
+        """
+        Copy `existing`, a file previously written through this writer, to `dst`.
+
+        The copy happens in the writer thread after all the writes queued
+        before it, so `existing` does not need to be on disk yet.
+        """
+        self._put(('duplicate', dst, None, existing, on_error), 0)
+
+    def write(self, dst, data, on_error=None):
+        """Write `data` to the file at `dst`, replacing its contents."""
+        data = self._to_bytes(data)
+        self._put(('write', dst, data, None, on_error), len(data))
+
+    def append(self, dst, data, on_error=None):
+        """Append `data` to the file at `dst`."""
+        data = self._to_bytes(data)
+        self._put(('append', dst, data, None, on_error), len(data))
+
+    def makedirs(self, path, on_error=None):
+        """Create the directory `path` (and parents) if not already done."""
+        with self._dirs_lock:
+            if path in self._created_dirs:
+                return
+        self._put(('makedirs', path, None, None, on_error), 0)
+
+    def flush(self):
+        """Wait for all queued writes, then fsync every file and directory."""
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+        self._sync()
+
+    def close(self):
+        """Flush and stop the writer thread. The writer can still be reused."""
+        self.flush()
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._ops.append(None)
+            self._cond.notify_all()
+        thread.join()
+        with self._cond:
+            self._thread = None
+
+    @property
+    def queued_bytes(self):
+        """Number of bytes currently held in the queue."""
+        return self._queued_bytes
+
+    def _to_bytes(self, data):
+        if isinstance(data, str):
+            return data.encode('utf-8')
+        return bytes(data)
+
+    def _put(self, op, nbytes):
+        with self._cond:
+            while self._queued_bytes and self._queued_bytes + nbytes > self.max_queue_bytes:
+                self._cond.wait()
+            self._ops.append(op)
+            self._queued_bytes += nbytes
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker,
+                                                name='DestinationWriter')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ops:
+                    self._cond.wait()
+                op = self._ops.popleft()
+            if op is None:
+                return
+            # `extra` is the file mode for writes, the source path for duplicates
+            kind, path, data, extra, on_error = op
+            nbytes = len(data) if data is not None else 0
+            try:
+                self._run_op(kind, path, data, extra)
+            except Exception as e:
+                self._report(e, on_error, path)
+            with self._cond:
+                self._queued_bytes -= nbytes
+                self._pending -= 1
+                self._cond.notify_all()
+            if self.checkpoint_bytes and self._bytes_since_sync >= self.checkpoint_bytes:
+                self._sync()
+
+    def _copy_now(self, src, dst, size):
+        self._makedirs(os.path.dirname(dst))
+        shutil.copy(src, dst)
+        self._mark_dirty(dst, size)
+
+    def _run_op(self, kind, path, data, extra):
+        if kind == 'makedirs':
+            self._makedirs(path)
+            return
+        self._makedirs(os.path.dirname(path))
+        if kind == 'duplicate':
+            shutil.copy(extra, path)
+            self._mark_dirty(path, os.path.getsize(path))
+            return
+        open_mode = 'ab' if kind == 'append' else 'wb'
+        with open(path, open_mode) as f:
+            f.write(data)
+        if extra is not None:
+            os.chmod(path, stat.S_IMODE(extra))
+        self._mark_dirty(path, len(data))
+
+    def _makedirs(self, path):
+        with self._dirs_lock:
+            if not path or path in self._created_dirs:
+                return
+            if not os.path.isdir(path):
+                # The new directories and the existing parent of the topmost
+                # one all get new entries that need to be synced
+                parent = path
+                while parent and not os.path.isdir(parent):
+                    self._dirty_dirs.add(parent)
+                    parent = os.path.dirname(parent)
+                self._dirty_dirs.add(parent or os.curdir)
+                os.makedirs(path, exist_ok=True)
+            self._created_dirs.add(path)
+
+    def _mark_dirty(self, path, nbytes):
+        with self._dirs_lock:
+            self._dirty_files.add(path)
+            self._dirty_dirs.add(os.path.dirname(path))
+            self._bytes_since_sync += nbytes
+            self.bytes_written += nbytes
+
+    def _sync(self):
+        with self._dirs_lock:
+            files, self._dirty_files = self._dirty_files, set()
+            dirs, self._dirty_dirs = self._dirty_dirs, set()
+            self._bytes_since_sync = 0
+        if not self.durable:
+            return
+        # Files first, then the directory entries pointing to them
+        for path in sorted(files) + sorted(dirs, reverse=True):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                # Some platforms/filesystems can't fsync directories
+                pass
+            finally:
+                os.close(fd)
+
+    def _report(self, error, on_error, path=None):
+        if path is not None:
+            with self._dirs_lock:
+                self.failed.setdefault(path, error)
+        if on_error is None:
+            self.errors.append(error)
+            return
+        try:
+            on_error(error)
+        except Exception as e:
+            # Must not stop the writer thread, flush() would never return
+            self.errors.append(e)
+
+
+class ArchiveWriter(DestinationWriter):
+    """
+    Write-behind writer packing the destination in one uncompressed archive.
+
+    Creating many small files is slow on FAT32 keys (each one updates
+    directory entries and the FAT), while one big file is written
+    sequentially. Files are stored by the writer thread, in order, in the
+    zip or tar (`archive_format`) at `archive_path`, named by their path
+    relative to `root_path`. Appended files are kept in memory until
+    close(), which completes the archive: the writer can't be reused.
+    """
+
+    formats = ('zip', 'tar')
+
+    def __init__(self, archive_path, root_path, archive_format='zip', **kwargs):
+        if archive_format not in self.formats:
+            raise ValueError('Unknown archive format: {}'.format(archive_format))
+        super(ArchiveWriter, self).__init__(**kwargs)
+        self.archive_path = archive_path
+        self.root_path = root_path
+        self.archive_format = archive_format
+        self._file = None
+        self._archive = None  # Opened on the first write
+        self._archive_lock = threading.Lock()
+        self._closed = False
+        self._members = {}  # path: (offset, size) of the data in the archive file
+        self._appended = collections.OrderedDict()  # path: bytearray
+
+    def close(self):
+        """Flush, store the appended files and complete the archive."""
+        super(ArchiveWriter, self).close()
+        if self._closed:
+            return
+        for path, data in self._appended.items():
+            self._add_member(path, bytes(data))
+        self._appended.clear()
+        with self._archive_lock:
+            self._open()
+            self._archive.close()
+            self._file.close()
+            self._closed = True
+        self._mark_dirty(self.archive_path, 0)
+        self._sync()
+
+    def _copy_now(self, src, dst, size):
+        self._add_member(dst, src_path=src)
+
+    def _run_op(self, kind, path, data, extra):
+        if kind == 'makedirs':
+            return  # Directories are implied by the member names
+        if kind == 'append':
+            with self._archive_lock:
+                self._appended.setdefault(path, bytearray()).extend(data)
+            return
+        if kind == 'duplicate':
+            data = self._read_member(extra)
+            extra = None
+        self._add_member(path, data, mode=extra)
+
+    def _open(self):
+        if self._closed:
+            raise ValueError('{} is already closed'.format(self.archive_path))
+        if self._archive is None:
+            self._makedirs(os.path.dirname(self.archive_path))
+            self._file = open(self.archive_path, 'w+b')
+            if self.archive_format == 'zip':
+                self._archive = zipfile.ZipFile(self._file, 'w', zipfile.ZIP_STORED)
+            else:
+                self._archive = tarfile.open(fileobj=self._file, mode='w',
+                                             format=tarfile.PAX_FORMAT)
+
+    def _add_member(self, path, data=None, src_path=None, mode=None):
+        """Store `data` (bytes), or the file at `src_path`, as the file at `path`."""
+        name = os.path.relpath(path, self.root_path)
+        if src_path is not None:
+            src_stat = os.stat(src_path)
+            size, mode = src_stat.st_size, src_stat.st_mode
+        else:
+            size = len(data)
+        mode = stat.S_IMODE(mode) if mode is not None else 0o644
+        with self._archive_lock:
+            self._open()
+            if self.archive_format == 'zip':
+                if src_path is not None:
+                    # Streamed from the file (ZipFile.open() can only write from 3.6)
+                    self._archive.write(src_path, name)
+                else:
+                    info = zipfile.ZipInfo(name, time.localtime()[:6])
+                    info.external_attr = mode << 16
+                    self._archive.writestr(info, data)
+                offset = self._file.tell() - size
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mode = mode
+                info.mtime = time.time()
+                if src_path is not None:
+                    with open(src_path, 'rb') as f:
+                        self._archive.addfile(info, f)
+                else:
+                    self._archive.addfile(info, io.BytesIO(data))
+                # The data is padded to a whole number of blocks
+                blocks = -(-size // tarfile.BLOCKSIZE)
+                offset = self._file.tell() - blocks * tarfile.BLOCKSIZE
+            self._members[path] = (offset, size)
+        self._mark_dirty(self.archive_path, size)
+
+    def _read_member(self, path):
+        """Return the data of the file stored at `path`."""
+        with self._archive_lock:
+            offset, size = self._members[path]
+            end = self._file.tell()
+            self._file.seek(offset)
+            data = self._file.read(size)
+            self._file.seek(end)
+        return data
+
+    def _sync(self):
+        with self._archive_lock:
+            if self._file is not None and not self._file.closed:
+                self._file.flush()
+        super(ArchiveWriter, self)._sync()
+
+
+class MemoryWriter(object):
+    """
+    Writer keeping the destination files in memory.
+
+    Has the interface of DestinationWriter, for use when the sanitized files
+    are wanted as buffers rather than on disk. Written files are in `files`,
+    by destination path.
+    """
+
+    def __init__(self):
+        self.files = {}  # path: bytearray
+        self.errors = []
+        self.failed = {}  # path: error, like DestinationWriter.failed
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def copy(self, src, dst, on_error=None):
+        """Copy the file at `src` (on disk) to `dst`."""
+        try:
+            with open(src, 'rb') as f:
+                self.write(dst, f.read())
+        except Exception as e:
+            self._report(e, on_error, dst)
+
+    def duplicate(self, existing, dst, on_error=None):
+        """Copy `existing`, a file previously written through this writer, to `dst`."""
+        with self._lock:
+            data = self.files.get(existing)
+        if data is None:
+            self._report(FileNotFoundError(existing), on_error, dst)
+        else:
+            self.write(dst, data)
+
+    def write(self, dst, data, on_error=None):
+        """Write `data` to the file at `dst`, replacing its contents."""
+        data = bytearray(data.encode('utf-8') if isinstance(data, str) else data)
+        with self._lock:
+            self.files[dst] = data
+            self.bytes_written += len(data)
+
+    def append(self, dst, data, on_error=None):
+        """Append `data` to the file at `dst`."""
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        with self._lock:
+            self.files.setdefault(dst, bytearray()).extend(data)
+            self.bytes_written += len(data)
+
+    def makedirs(self, path, on_error=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    @property
+    def queued_bytes(self):
+        return 0
+
+    def getvalue(self, path):
+        """Return the contents of the file at `path` as bytes."""
+        return bytes(self.files[path])
+
+    def open(self, path):
+        """Return a binary file object reading the file at `path`."""
+        return io.BytesIO(self.files[path])
+
+    def _report(self, error, on_error, path):
+        self.failed.setdefault(path, error)
+        if on_error is not None:
+            on_error(error)
+        else:
+            self.errors.append(error)
+
+
+Progress = collections.namedtuple('Progress', [
+    'files_discovered', 'files_processed', 'bytes_total', 'bytes_processed',
+    'elapsed', 'throughput', 'eta', 'current_file', 'finished'])
+Progress.__doc__ = """
+Snapshot of the progress of a run.
+
+`throughput` is in bytes per second, `elapsed` and `eta` in seconds (`eta`
+is None until it can be estimated).
+"""
+
+
+class ProgressTracker(object):
+    """
+    Keep track of the progress of a run and report it to a callback.
+
+    `callback` is called with a Progress snapshot at most once every
+    `interval` seconds, and once more when finish() is called. Updating the
+    tracker is cheap, so it can be done for every file.
+    """
+
+    def __init__(self, callback, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.files_discovered = 0
+        self.files_processed = 0
+        self.bytes_total = 0
+        self.bytes_processed = 0
+        self.current_file = None
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self._last_report = None
+
+    def start(self):
+        """Start the clock used for throughput and ETA."""
+        self._start_time = time.monotonic()
+
+    def add_discovered(self, size):
+        """Count a file of `size` bytes found while walking the source."""
+        with self._lock:
+            self.files_discovered += 1
+            self.bytes_total += size
+
+    def start_file(self, path):
+        """Report that processing of the file at `path` begins."""
+        self.current_file = path
+        self._maybe_report()
+
+    def file_done(self, size):
+        """Count a processed file of `size` bytes."""
+        with self._lock:
+            self.files_processed += 1
+            self.bytes_processed += size
+        self._maybe_report()
+
+    def finish(self):
+        """Report the final progress."""
+        self.current_file = None
+        self._last_report = time.monotonic()
+        self.callback(self.snapshot(finished=True))
+
+    def snapshot(self, finished=False):
+        """Return the current progress as a Progress."""
+        with self._lock:
+            elapsed = time.monotonic() - self._start_time
+            throughput = self.bytes_processed / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if finished:
+                eta = 0.0
+            elif self.bytes_processed and throughput:
+                eta = (self.bytes_total - self.bytes_processed) / throughput
+            elif self.files_processed and not self.bytes_total:
+                eta = (self.files_discovered - self.files_processed) * elapsed / self.files_processed
+            return Progress(self.files_discovered, self.files_processed,
+                            self.bytes_total, self.bytes_processed, elapsed,
+                            throughput, eta if eta is None else max(eta, 0.0),
+                            self.current_file, finished)
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._last_report is not None and now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        self.callback(self.snapshot())
+
+
+def print_progress(progress, stream=None, width=79):
+    """Render a Progress as a single, continuously updated line on a terminal."""
+    if stream is None:
+        stream = sys.stderr
+    mb = 1024 * 1024
+    if progress.eta is None:
+        eta = '--:--'
+    else:
+        eta = '{:02d}:{:02d}'.format(*divmod(int(progress.eta), 60))
+    line = '{}/{} files, {:.1f}/{:.1f} MB, {:.1f} MB/s, ETA {}'.format(
+        progress.files_processed, progress.files_discovered,
+        progress.bytes_processed / mb, progress.bytes_total / mb,
+        progress.throughput / mb, eta)
+    if progress.current_file:
+        line += ' - ' + progress.current_file
+    if len(line) > width:
+        line = line[:width - 3] + '...'
+    stream.write('\r' + line.ljust(width))
+    if progress.finished:
+        stream.write('\n')
+    stream.flush()
+
+
 class KittenGroomerBase(object):
     """Base object responsible for copy/sanitization process."""
 
@@ -2,17 +2,34 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import json
+import time
 import shutil
+import zipfile
+import socket
+import threading
+import tracemalloc
+import subprocess
 
 import pytest
 
+from kittengroomer import MemoryWriter
 from tests.logging import save_logs
 try:
-    from bin.filecheck import KittenGroomerFileCheck, File, main
+    from bin.filecheck import KittenGroomerFileCheck, File, GroomerDaemon, submit_job, main
+    from bin.filecheck import CostScheduler, GroomerLogger, ResultStore, ScratchSpace, lookup_run_log
+    from bin.filecheck import CapacityPlanner, InsufficientSpace, FileProfiler
+    from bin.filecheck import warm_up
+    warm_up()
     NODEPS = False
 except ImportError:
     NODEPS = True
 
+# Budget for `import bin.filecheck`, in microseconds. Wall-clock times
+# depend on the machine, so the budget is only checked when set.
+IMPORT_TIME_BUDGET = os.environ.get('FILECHECK_IMPORT_BUDGET')
+
 fixture = pytest.fixture
 skip = pytest.mark.skip
 skipif_nodeps = pytest.mark.skipif(NODEPS,
@@ -50,6 +67,802 @@ class TestSystem:
         test_description = "filecheck_invalid"
         save_logs(invalid_groomer, test_description)
 
+    def test_parallel_log_matches_serial(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        logs = []
+        for workers in (1, 4):
+            dst_path = tmpdir.mkdir('dst{}'.format(workers)).strpath
+            groomer = KittenGroomerFileCheck(src_path, dst_path, workers=workers)
+            groomer.run()
+            with open(groomer.logger.log_path) as log_file:
+                logs.append(log_file.read())
+        assert logs[0] == logs[1]
+
+
+@skipif_nodeps
+class TestStructuredLog:
+
+    def test_records_and_lookup(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, workers=2)
+        groomer.run()
+        with open(groomer.logger.jsonl_path) as jsonl_file:
+            records = [json.loads(line) for line in jsonl_file]
+        paths = [record['path'] for record in records]
+        assert 'blah.zip/blah.txt' in paths
+        log_dir = os.path.dirname(groomer.logger.jsonl_path)
+        record, = lookup_run_log(log_dir, path='autorun.inf')
+        assert record['safety_category'] == 'dangerous'
+        assert record['handler'] == '_unknown_app'
+        assert len(record['sha256']) == 64
+        same = lookup_run_log(log_dir, sha256=record['sha256'])
+        assert record in same
+        assert lookup_run_log(log_dir, path='missing') == []
+
+    def test_disabled(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, structured_log=False)
+        groomer.run()
+        assert not os.path.exists(groomer.logger.jsonl_path)
+        assert not os.path.exists(groomer.logger.index_path)
+
+    def test_write_errors_logged(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        tmpdir.mkdir('DANGEROUS_blah.conf_DANGEROUS')  # Where blah.conf is written
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath)
+        groomer.run()
+        log_dir = os.path.dirname(groomer.logger.jsonl_path)
+        record, = lookup_run_log(log_dir, path='blah.conf')
+        assert not record['copied']
+        assert record['errors'][0]['type'] == 'IsADirectoryError'
+        record, = lookup_run_log(log_dir, path='Example.jpg')
+        assert record['copied']
+        assert record['errors'] == []
+        with open(groomer.logger.log_path) as log_file:
+            log = log_file.read()
+        assert 'Not written: ' in log
+        assert 'Not written to the destination: 1 files' in log
+
+
+@skipif_nodeps
+class TestLogTree:
+
+    def test_files_added_out_of_order(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.mkdir('sub').join('b.txt').write('b')
+        src.join('a.txt').write('a')
+        src.join('c.zip').write('c')
+        member_dir = tmpdir.mkdir('c.zip_temp')
+        member_dir.join('d.txt').write('d')
+        logger = GroomerLogger(src.strpath, tmpdir.mkdir('dst').strpath)
+        paths = [src.join('c.zip'), member_dir.join('d.txt'), src.join('sub', 'b.txt'), src.join('a.txt')]
+        for path in paths:
+            if path.basename == 'c.zip':
+                logger.add_archive_dir(member_dir.strpath, path.strpath)
+            file = File(path.strpath, path.strpath, logger)
+            logger.add_file(file.src_path, file.get_all_props())
+        logger.add_dir(src.join('sub').strpath)
+        logger.finish()
+        with open(logger.log_path) as log_file:
+            names = [line.rstrip().split(' (')[0] for line in log_file]
+        assert names == ['src/', '   +- a.txt', '   +- c.zip', '   |  +- d.txt',
+                         '   +- sub/', '   |  +- b.txt']
+
+
+@skipif_nodeps
+class TestResultStore:
+
+    def test_queries(self):
+        store = ResultStore()
+        store.add('a.txt', 10, None, 'text/plain', 'text', 0.1)
+        store.add('b.exe', 300, 'dangerous', 'application/x-dosexec', '_executables', 0.2)
+        store.add('c.pdf', 200, 'dangerous', 'application/pdf', '_pdf', 1.5)
+        store.add('d.txt', 20, None, 'text/plain', 'text', 0.1)
+        assert len(store) == 4
+        assert store.count_by_mimetype()['text/plain'] == 2
+        assert store.bytes_by_category() == {'normal': 30, 'dangerous': 500}
+        assert store.largest('dangerous', 1) == [('b.exe', 300)]
+        assert store.largest(count=2) == [('b.exe', 300), ('c.pdf', 200)]
+        assert store.slowest_handlers(1) == [('_pdf', 1.5, 1)]
+        assert store.summary_lines()[0] == 'Summary: 4 files, 530B'
+
+    def test_summary_escapes_names(self):
+        store = ResultStore()
+        store.add('test\u202eexe.txt', 37, 'dangerous', 'text/plain', 'text', 0.1)
+        store.add('bell\x07\x1b[2J.txt', 10, 'dangerous', 'text/plain', 'text', 0.1)
+        line = store.summary_lines()[-1]
+        assert line == '   Largest dangerous files: test\\u202eexe.txt (37B), bell\\u0007\\u001b[2J.txt (10B)'
+
+    def test_run_summary(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath)
+        groomer.run()
+        assert groomer.results.count_by_category()['dangerous'] > 0
+        with open(groomer.logger.log_path) as log_file:
+            log = log_file.read()
+        assert '\nSummary: {} files'.format(len(groomer.results)) in log
+
+
+@skipif_nodeps
+class TestScratchSpace:
+
+    def test_budget(self, tmpdir):
+        scratch = ScratchSpace(tmpdir.mkdir('scratch').strpath, budget=100)
+        first = scratch.make_dir('a.zip', 60, tmpdir.join('a.zip_temp').strpath)
+        assert first.startswith(scratch.root_path)
+        fallback = tmpdir.join('b.zip_temp').strpath
+        assert scratch.make_dir('b.zip', 60, fallback) == fallback
+        scratch.release(first)
+        assert not os.path.exists(first)
+        assert scratch.make_dir('b.zip', 60, fallback).startswith(scratch.root_path)
+        scratch.close()
+        assert not os.path.exists(scratch.root_path)
+
+    def test_stale_removed(self, tmpdir):
+        base = tmpdir.mkdir('scratch')
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        stale = base.mkdir(ScratchSpace.prefix + '{}_xyz'.format(pid))
+        scratch = ScratchSpace(base.strpath)
+        assert not stale.exists()
+        assert os.path.exists(scratch.root_path)
+        ScratchSpace(base.strpath)
+        assert os.path.exists(scratch.root_path)
+
+    def test_file_tempdir(self, tmpdir):
+        scratch = ScratchSpace(tmpdir.mkdir('scratch').strpath)
+        path = os.path.join(os.getcwd(), 'tests/src_valid/blah.conf')
+        dst = tmpdir.join('dst', 'blah.conf').strpath
+        file = File(path, dst, None, scratch=scratch)
+        tempdir_path = file.make_tempdir()
+        assert tempdir_path.startswith(scratch.root_path)
+        file.remove_tempdir()
+        assert not os.path.exists(tempdir_path)
+        assert not os.path.exists(os.path.dirname(dst))
+
+    def test_run_cleans_up(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.mkdir('dst').strpath,
+                                         scratch_path=tmpdir.mkdir('scratch').strpath)
+        groomer.run()
+        assert tmpdir.join('scratch').listdir() == []
+        assert not any(name.endswith('_temp') for name in os.listdir(groomer.dst_root_path))
+
+
+@skipif_nodeps
+class TestParallelArchives:
+
+    @fixture
+    def src_path(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        with zipfile.ZipFile(src.join('outer.zip').strpath, 'w') as outer:
+            for i in range(6):
+                outer.writestr('member{}.txt'.format(i), 'text {}'.format(i))
+            inner_path = tmpdir.join('inner.zip').strpath
+            with zipfile.ZipFile(inner_path, 'w') as inner:
+                inner.writestr('deep.txt', 'deep')
+            outer.write(inner_path, 'inner.zip')
+        src.join('plain.txt').write('plain')
+        return src.strpath
+
+    def test_members_in_parallel(self, tmpdir, src_path):
+        threads = {}
+
+        class RecordingGroomer(KittenGroomerFileCheck):
+            def process_file(self, file, depth=0):
+                if depth > 0:
+                    threads[file.filename] = (threading.get_ident(), depth)
+                    time.sleep(0.05)
+                super(RecordingGroomer, self).process_file(file, depth)
+
+        logs = []
+        for workers in (1, 4):
+            threads.clear()
+            groomer = RecordingGroomer(src_path, tmpdir.mkdir('dst{}'.format(workers)).strpath,
+                                       workers=workers)
+            groomer.run()
+            with open(groomer.logger.log_path) as log_file:
+                logs.append(log_file.read())
+        assert logs[0] == logs[1]
+        assert len(set(ident for ident, depth in threads.values())) > 1
+        assert threads['member0.txt'][1] == 1
+        assert 'deep.txt' not in threads  # inner.zip is an archive bomb at the default depth
+        assert groomer.results.largest('dangerous') == [('outer.zip/inner.zip', 118)]
+
+
+@skipif_nodeps
+class TestIterProcess:
+
+    def test_yields_every_file(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, workers=2)
+        results = {result.path: result for result in groomer.iter_process()}
+        groomer.finish()
+        assert len(results) == len(groomer.results)
+        assert results['autorun.inf'].is_dangerous
+        assert 'blah.zip/blah.txt' in results
+        assert os.path.exists(groomer.logger.log_path)
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_stop_early(self, tmpdir, workers):
+        src_dir = tmpdir.mkdir('src')
+        for i in range(20):
+            src_dir.join('{}.txt'.format(i)).write('text')
+        groomer = KittenGroomerFileCheck(src_dir.strpath, tmpdir.join('dst').strpath, workers=workers)
+        for result in groomer.iter_process():
+            break
+        groomer.finish()
+        # The result consumed, those waiting in the queue, and one in progress per worker
+        assert len(groomer.results) <= 1 + 2 * workers
+
+    def test_error_logged(self, tmpdir):
+        class FailingGroomer(KittenGroomerFileCheck):
+            def process_file(self, file, depth=0):
+                if file.filename == 'Example.jpg':
+                    raise RuntimeError('failed')
+                super(FailingGroomer, self).process_file(file, depth)
+
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = FailingGroomer(src_path, tmpdir.strpath)
+        with pytest.raises(RuntimeError):
+            groomer.run()
+        assert os.path.exists(groomer.logger.log_path)
+        assert os.path.exists(os.path.join(tmpdir.strpath, 'DANGEROUS_blah.conf_DANGEROUS'))
+
+    def test_paths(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath)
+        paths = [os.path.join(src_path, 'blah.conf'), os.path.join(src_path, 'dir1')]
+        results = [result.path for result in groomer.iter_process(paths)]
+        groomer.finish()
+        assert sorted(results) == ['blah.conf', 'dir1/dir2/blah.conf']
+        with pytest.raises(ValueError):
+            list(groomer.iter_process([os.getcwd()]))
+
+
+@skipif_nodeps
+class TestProcessBuffer:
+
+    @fixture
+    def groomer(self, tmpdir):
+        return KittenGroomerFileCheck(tmpdir.join('src').strpath, tmpdir.join('dst').strpath,
+                                      writer=MemoryWriter())
+
+    def test_bytes(self, groomer):
+        with open('tests/src_invalid/geneve_1564.pdf', 'rb') as f:
+            data = f.read()
+        results = groomer.process_buffer(data, 'geneve_1564.pdf')
+        assert [result.path for result in results] == ['geneve_1564.pdf']
+        assert results[0].mimetype == 'application/pdf'
+        assert groomer.writer.getvalue(results[0].dst_path) == data
+        groomer.finish()
+        assert not os.path.exists(groomer.dst_root_path + '/geneve_1564.pdf')
+
+    def test_file_object(self, groomer):
+        with open('tests/src_valid/Example.jpg', 'rb') as f:
+            results = groomer.process_buffer(f, 'Example.jpg')
+        assert results[0].get_property('safety_category') is None
+        assert groomer.writer.getvalue(results[0].dst_path)[:2] == b'\xff\xd8'
+
+    def test_archive(self, groomer):
+        with open('tests/src_invalid/blah.zip', 'rb') as f:
+            results = groomer.process_buffer(f.read(), 'blah.zip')
+        paths = [result.path for result in results]
+        assert paths[-1] == 'blah.zip'
+        assert 'blah.zip/blah.txt' in paths
+        assert os.listdir(groomer.scratch.root_path) == []
+        groomer.finish()
+
+    @pytest.mark.parametrize('filename', ['../escaped.txt', 'dir/../../escaped.txt', '', '.', None])
+    def test_invalid_names(self, tmpdir, filename):
+        groomer = KittenGroomerFileCheck(tmpdir.join('src').strpath, tmpdir.join('dst').strpath)
+        with pytest.raises(ValueError):
+            groomer.process_buffer(b'x', filename)
+        groomer.finish()
+        assert not tmpdir.join('escaped.txt').exists()
+        assert os.listdir(groomer.output_root_path) == ['logs']
+
+    def test_absolute_name(self, tmpdir):
+        groomer = KittenGroomerFileCheck(tmpdir.join('src').strpath, tmpdir.join('dst').strpath)
+        with pytest.raises(ValueError):
+            groomer.process_buffer(b'x', tmpdir.join('escaped.txt').strpath)
+        groomer.finish()
+        assert not tmpdir.join('escaped.txt').exists()
+
+
+@skipif_nodeps
+class TestArchiveOutput:
+
+    def test_same_files_as_directory_output(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.join('files').strpath)
+        groomer.run()
+        expected = set()
+        for dir_path, dir_names, file_names in os.walk(groomer.dst_root_path):
+            for file_name in file_names:
+                expected.add(os.path.relpath(os.path.join(dir_path, file_name), groomer.dst_root_path))
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.join('archive').strpath, archive_format='zip')
+        groomer.run()
+        assert os.listdir(groomer.dst_root_path) == ['circlean.zip']
+        with zipfile.ZipFile(os.path.join(groomer.dst_root_path, 'circlean.zip')) as archive:
+            assert set(archive.namelist()) == expected
+            assert archive.read('blah.txt') == open(os.path.join(src_path, 'blah.txt'), 'rb').read()
+
+
+@skipif_nodeps
+class TestTimeBudget:
+
+    def test_out_of_time(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, time_budget=0)
+        groomer.run()
+        assert sorted(groomer.skipped) == sorted(path for path, size in groomer.results.largest(count=100))
+        assert 'blah.zip/blah.txt' not in groomer.skipped  # Not expanded
+        assert os.listdir(tmpdir.strpath) == ['logs']
+        with open(groomer.logger.log_path) as log_file:
+            log = log_file.read()
+        assert 'Not checked: out of time' in log
+        assert 'Not checked (out of time): {} files'.format(len(groomer.skipped)) in log
+
+    def test_expensive_handlers_skipped(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, time_budget=60)
+        groomer.scheduler.default_costs = dict(groomer.scheduler.default_costs, image=(100, 0))
+        # Cheap handlers still run, even when not expected to fit
+        groomer.scheduler.default_cost = (100, 0)
+        results = {result.path: result for result in groomer.iter_process()}
+        groomer.finish()
+        assert groomer.skipped == ['Example.jpg']
+        assert results['Example.jpg'].is_dangerous
+        assert 'test.zip/blah.conf' in results
+        assert not os.path.exists(os.path.join(tmpdir.strpath, 'Example.jpg'))
+        assert os.path.exists(os.path.join(tmpdir.strpath, 'DANGEROUS_blah.conf_DANGEROUS'))
+
+    def test_slow_handler(self, tmpdir, monkeypatch):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        release = threading.Event()
+        late = threading.Event()
+
+        def slow_image(file):
+            release.wait(30)
+            # Given up on: neither logged nor written
+            file.add_description('Late description')
+            file.write_dst_file(file.dst_path + '.late', b'late')
+            late.set()
+
+        monkeypatch.setattr(File, 'image', slow_image)
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, time_budget=0.5)
+        start = time.monotonic()
+        try:
+            results = {result.path: result for result in groomer.iter_process()}
+        finally:
+            release.set()
+        assert late.wait(10)
+        groomer.finish()
+        assert time.monotonic() - start < 10
+        assert 'Example.jpg' in groomer.skipped
+        assert 'Not fully checked: out of time' in results['Example.jpg'].get_property('description_string')
+        assert not os.path.exists(os.path.join(tmpdir.strpath, 'Example.jpg'))
+        assert not os.path.exists(os.path.join(tmpdir.strpath, 'Example.jpg.late'))
+        with open(groomer.logger.log_path) as log_file:
+            assert 'Late description' not in log_file.read()
+        assert 'image' not in groomer.scheduler.stats
+
+    def test_skipped_not_recorded(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, time_budget=0)
+        groomer.run()
+        assert groomer.scheduler.stats == {}
+
+    def test_check_threads_reused(self, tmpdir):
+        def check_threads():
+            return [thread for thread in threading.enumerate() if thread.name == 'circlean-check']
+
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        before = check_threads()
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, time_budget=60)
+        groomer.run()
+        assert len(check_threads()) - len(before) == 1
+
+
+@skipif_nodeps
+class TestCapacityPlanning:
+
+    @fixture
+    def free_space(self, monkeypatch):
+        def set_free_space(nbytes):
+            free = os.statvfs_result((4096, 4096, 0, 0, nbytes // 4096, 0, 0, 0, 0, 255))
+            monkeypatch.setattr(os, 'statvfs', lambda path: free)
+        return set_free_space
+
+    def test_estimate(self, tmpdir, free_space):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        free_space(0)
+        planner = CapacityPlanner(tmpdir.strpath)
+        for name, handler_name in (('Example.jpg', 'image'), ('blah.conf', 'text'), ('test.zip', '_archive')):
+            path = os.path.join(src_path, name)
+            planner.add(path, os.path.getsize(path), handler_name, has_metadata=handler_name == 'image')
+        assert planner.sizes[os.path.join(src_path, 'Example.jpg')] == (7 + 4) * 4096  # Image and metadata
+        assert planner.sizes[os.path.join(src_path, 'blah.conf')] == 4096
+        assert planner.sizes[os.path.join(src_path, 'test.zip')] == 4096  # Its member
+
+    def test_handler_for(self):
+        assert File.handler_for(File.guess_mimetype('photo.JPG')) == 'image'
+        assert File.handler_for(File.guess_mimetype('test.zip')) == '_archive'
+        assert File.handler_for(File.guess_mimetype('report.pdf')) == '_pdf'
+        assert File.handler_for(None) == 'unknown'
+
+    def test_abort(self, tmpdir, free_space):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        free_space(CapacityPlanner.reserve)
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, capacity_policy='abort')
+        with pytest.raises(InsufficientSpace):
+            groomer.run()
+        assert os.listdir(tmpdir.strpath) == []
+
+    def test_source_order(self, tmpdir, free_space):
+        free_space(CapacityPlanner.reserve + 3 * 4096)
+        planner = CapacityPlanner(tmpdir.strpath)
+        for name, size in (('z.txt', 4096), ('big.txt', 2 * 4096), ('a.txt', 4096), ('b.txt', 4096)):
+            planner.add(name, size, 'text')
+        assert planner.plan('order') == {'a.txt', 'b.txt'}
+        assert planner.plan('smallest') == {'big.txt'}
+
+    def test_smallest_first(self, tmpdir, free_space):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        free_space(CapacityPlanner.reserve + 4 * 4096)
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, capacity_policy='smallest')
+        results = {result.path: result for result in groomer.iter_process()}
+        groomer.finish()
+        assert groomer.not_copied == {os.path.join(src_path, 'Example.jpg')}
+        assert not results['Example.jpg'].get_property('copied')
+        assert 'Not copied: not enough space on the destination' in \
+            results['Example.jpg'].get_property('description_string')
+        assert os.path.exists(os.path.join(tmpdir.strpath, 'DANGEROUS_blah.conf_DANGEROUS'))
+        assert not os.path.exists(os.path.join(tmpdir.strpath, 'Example.jpg'))
+
+
+@skipif_nodeps
+class TestProfiling:
+
+    def test_report(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, profile=True, trace_memory=True, workers=4)
+        groomer.run()
+        assert groomer.workers == 1
+        assert not tracemalloc.is_tracing()
+        assert sorted(groomer.profiler.profiles) == ['_archive', 'image', 'text']
+        stages = {path: stages for path, handler_name, seconds, stages in groomer.profiler.files}
+        assert [stage for stage, seconds, peak in stages['Example.jpg']] == [
+            '_check_filename', '_check_dangerous', '_check_extension', '_check_mimetype', 'image']
+        with open(groomer.profile_path) as profile_file:
+            report = profile_file.read()
+        assert 'Slowest files:' in report
+        assert 'Largest memory peaks:' in report
+        assert 'Functions of image (cumulative):' in report
+
+    def test_count(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, profile=True, profile_count=2)
+        groomer.run()
+        with open(groomer.profile_path) as profile_file:
+            slowest = profile_file.read().split('Slowest files:\n')[1].split('Functions of')[0]
+        assert len(slowest.splitlines()) == 2
+
+    def test_tracing_left_running(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        tracemalloc.start()
+        try:
+            KittenGroomerFileCheck(src_path, tmpdir.strpath, trace_memory=True).run()
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
+
+    def test_stage_peaks(self):
+        class FakeFile(object):
+            handler_name = 'text'
+
+            def get_property(self, name):
+                return 'fake.txt'
+
+            def _allocate(self):
+                self.data = bytearray(1024 ** 2)
+
+            def _check_filename(self):
+                pass
+
+        profiler = FileProfiler(profile=False, trace_memory=True)
+        fake_file = FakeFile()
+        try:
+            profiler.run_check(fake_file, '_allocate')
+            profiler.run_check(fake_file, '_check_filename')
+        finally:
+            profiler.close()
+        profiler.file_done(fake_file, 'fake.txt', 'text', 0)
+        (allocate, check_filename), = [stages for path, handler_name, seconds, stages in profiler.files]
+        assert allocate[2] >= 1024 ** 2
+        # The peak of the previous stage is not carried over
+        assert check_filename[2] < 1024 ** 2
+
+    def test_trace_memory_option(self, tmpdir, monkeypatch):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        dst_path = tmpdir.strpath
+        monkeypatch.setattr(sys, 'argv', ['filecheck.py', '-s', src_path, '-d', dst_path, '--trace-memory',
+                                          '--profile-count', '1'])
+        main(KittenGroomerFileCheck, 'File sanitizer used in CIRCLean.')
+        assert not tracemalloc.is_tracing()
+        with open(os.path.join(dst_path, 'logs', 'circlean_profile.txt')) as profile_file:
+            report = profile_file.read()
+        assert 'Functions of' not in report
+        assert len(report.split('Largest memory peaks:\n')[1].splitlines()) == 1
+
+
+@skipif_nodeps
+class TestScanOnly:
+
+    def test_scan_only_writes_no_files(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        dst_path = tmpdir.mkdir('dst').strpath
+        groomer = KittenGroomerFileCheck(src_path, dst_path, scan_only=True)
+        groomer.run()
+        assert os.listdir(dst_path) == ['logs']
+        assert sorted(os.listdir(os.path.join(dst_path, 'logs'))) == [
+            'circlean_log.idx', 'circlean_log.jsonl', 'circlean_log.txt', 'circlean_report.json']
+        assert not os.path.exists(groomer.output_root_path)
+        with open(groomer.report_path) as report_file:
+            report = json.load(report_file)
+        entries = {entry['path']: entry for entry in report['files']}
+        assert entries['autorun.inf']['safety_category'] == 'dangerous'
+        assert entries['blah.txt']['safety_category'] == 'normal'
+        assert entries['blah.txt']['would_copy'] is True
+        assert entries['blah.zip/blah.txt']['mimetype'] == 'text/plain'
+
+    def test_scan_log_matches_groom_log(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        logs = []
+        for scan_only in (False, True):
+            dst_path = tmpdir.mkdir(str(scan_only)).strpath
+            groomer = KittenGroomerFileCheck(src_path, dst_path, scan_only=scan_only)
+            groomer.run()
+            with open(groomer.logger.log_path) as log_file:
+                logs.append(log_file.read())
+        assert logs[0] == logs[1]
+
+
+@skipif_nodeps
+class TestProgress:
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_progress(self, tmpdir, workers):
+        src_path = os.path.join(os.getcwd(), 'tests/src_valid')
+        reports = []
+        groomer = KittenGroomerFileCheck(src_path, tmpdir.strpath, workers=workers,
+                                         progress_callback=reports.append)
+        groomer.run()
+        final = reports[-1]
+        assert final.finished
+        assert final.files_processed == final.files_discovered == 4
+        assert final.bytes_processed == final.bytes_total > 0
+
+
+@skipif_nodeps
+class TestCostScheduler:
+
+    def test_default_costs(self):
+        scheduler = CostScheduler()
+        assert scheduler.estimate('_pdf', 10000) > scheduler.estimate('text', 10000)
+        assert scheduler.estimate('text', 10 ** 9) > scheduler.estimate('text', 10)
+
+    def test_order(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('small.txt').write('text')
+        src.join('big.txt').write('text' * 100000)
+        shutil.copy('tests/src_invalid/geneve_1564.pdf', src.strpath)
+        files = [File(path.strpath, path.strpath, None) for path in sorted(src.listdir())]
+        ordered = CostScheduler().order(files)
+        assert [f.filename for f in ordered] == ['geneve_1564.pdf', 'big.txt', 'small.txt']
+
+    def test_record_refines_estimates(self, tmpdir):
+        stats_path = tmpdir.join('costs.json').strpath
+        scheduler = CostScheduler(stats_path)
+        for size in (1000, 2000, 3000):
+            scheduler.record('text', size, 1 + size * 0.001)
+        fixed, per_byte = scheduler.coefficients('text')
+        assert abs(fixed - 1) < 1e-6 and abs(per_byte - 0.001) < 1e-9
+        scheduler.save()
+        assert CostScheduler(stats_path).coefficients('text') == (fixed, per_byte)
+
+
+@skipif_nodeps
+class TestDedup:
+
+    @fixture
+    def dup_src(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('a.txt').write('some text')
+        src.join('b.txt').write('some text')
+        src.join('c.exe').write('some text')
+        src.mkdir('sub').join('d.txt').write('some text')
+        for name in ('img1.jpg', 'img2.jpg'):
+            shutil.copy('tests/src_valid/Example.jpg', src.join(name).strpath)
+        return src.strpath
+
+    def test_only_checked_contents_recorded(self, tmpdir, dup_src):
+        groomer = KittenGroomerFileCheck(dup_src, tmpdir.mkdir('dst').strpath, dedup=True)
+        groomer.run()
+        # a.txt and img1.jpg: the others are duplicates, or dangerous by name (c.exe)
+        assert {handler_name: stats[0] for handler_name, stats in groomer.scheduler.stats.items()} == {
+            'text': 1, 'image': 1}
+
+    def test_duplicates_reuse_verdict(self, tmpdir, dup_src):
+        dst = tmpdir.mkdir('dst').strpath
+        groomer = KittenGroomerFileCheck(dup_src, dst, dedup=True)
+        groomer.run()
+        with open(groomer.logger.log_path) as log_file:
+            log = log_file.read()
+        assert 'b.txt' in log and 'Plain text file, Identical to a.txt' in log
+        assert 'Identical to img1.jpg' in log
+        assert 'Dangerous: Extension identifies file as potentially dangerous' in log.split('c.exe')[1]
+        assert len(groomer.seen_files) == 2
+        for name in ('a.txt', 'b.txt', 'd.txt', 'img1.jpg', 'img2.jpg', 'img2.jpg.metadata.txt'):
+            assert os.path.exists(os.path.join(dst, name))
+        with open(os.path.join(dst, 'img1.jpg'), 'rb') as img1, open(os.path.join(dst, 'img2.jpg'), 'rb') as img2:
+            assert img1.read() == img2.read()
+        assert os.path.exists(os.path.join(dst, 'DANGEROUS_c.exe_DANGEROUS'))
+
+
+@skipif_nodeps
+class TestGroomerDaemon:
+
+    @fixture
+    def src_path(self):
+        return os.path.join(os.getcwd(), 'tests/src_valid')
+
+    def test_spool_job(self, tmpdir, src_path):
+        spool_dir = tmpdir.mkdir('spool').strpath
+        dst_path = tmpdir.mkdir('dst').strpath
+        with open(os.path.join(spool_dir, 'key.job'), 'w') as job_file:
+            json.dump({'source': src_path, 'destination': dst_path}, job_file)
+        daemon = GroomerDaemon(KittenGroomerFileCheck, spool_dir=spool_dir)
+        daemon.handle_pending()
+        daemon.join()
+        assert os.listdir(spool_dir) == []
+        assert os.path.exists(os.path.join(dst_path, 'logs', 'circlean_log.txt'))
+
+    def test_failed_spool_job(self, tmpdir):
+        spool_dir = tmpdir.mkdir('spool').strpath
+        with open(os.path.join(spool_dir, 'key.job'), 'w') as job_file:
+            job_file.write('not json')
+        daemon = GroomerDaemon(KittenGroomerFileCheck, spool_dir=spool_dir)
+        daemon.handle_pending()
+        daemon.join()
+        assert os.listdir(spool_dir) == ['key.job.failed']
+
+    def test_socket_job(self, tmpdir, src_path):
+        socket_path = tmpdir.join('groomer.sock').strpath
+        dst_path = tmpdir.mkdir('dst').strpath
+        daemon = GroomerDaemon(KittenGroomerFileCheck, socket_path=socket_path,
+                               poll_interval=0.05)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            status = None
+            while status is None:
+                try:
+                    status = submit_job(socket_path, src_path, dst_path)
+                except (FileNotFoundError, ConnectionRefusedError):
+                    # Daemon isn't listening yet
+                    pass
+        finally:
+            daemon.stop()
+            thread.join()
+        assert status['status'] == 'done'
+        assert os.path.exists(os.path.join(dst_path, 'logs', 'circlean_log.txt'))
+
+    def test_socket_mode(self, tmpdir):
+        socket_path = tmpdir.join('groomer.sock').strpath
+        daemon = GroomerDaemon(KittenGroomerFileCheck, socket_path=socket_path)
+        daemon._open_socket()
+        try:
+            assert os.stat(socket_path).st_mode & 0o777 == 0o600
+        finally:
+            daemon._close_socket()
+
+    def test_idle_client(self, tmpdir, src_path):
+        socket_path = tmpdir.join('groomer.sock').strpath
+        dst_path = tmpdir.mkdir('dst').strpath
+        daemon = GroomerDaemon(KittenGroomerFileCheck, socket_path=socket_path)
+        daemon.job_read_timeout = 0.5
+        daemon._open_socket()
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            idle.connect(socket_path)
+            client.connect(socket_path)
+            client.sendall(bytes(json.dumps({'source': src_path, 'destination': dst_path}) + '\n', 'utf-8'))
+            start = time.monotonic()
+            while not daemon.workers:
+                daemon.handle_pending(timeout=0.05)
+            # Started while the idle client still hasn't sent anything
+            assert time.monotonic() - start < daemon.job_read_timeout
+            daemon.join()
+            assert json.loads(client.makefile('r').readline())['status'] == 'done'
+            while daemon._clients:
+                daemon.handle_pending(timeout=0.05)
+            assert json.loads(idle.makefile('r').readline()) == {'status': 'error', 'error': 'No job received'}
+        finally:
+            idle.close()
+            client.close()
+            daemon._close_socket()
+
+
+class TestImportTime:
+
+    def import_times(self):
+        """Return {module: cumulative import time in us} for bin.filecheck."""
+        # Once first, so that the bytecode is compiled and cached
+        subprocess.run([sys.executable, '-c', 'import bin.filecheck'], check=True)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bin.filecheck'],
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, module = line[len('import time:'):].split('|')
+            times[module.strip()] = int(cumulative)
+        return times
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs Python 3.7+")
+    def test_slow_modules_not_imported(self):
+        times = self.import_times()
+        for module in ('oletools', 'olefile', 'officedissector', 'exifread', 'PIL', 'pdfid'):
+            assert module not in times
+
+    @pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs Python 3.7+")
+    @pytest.mark.skipif(IMPORT_TIME_BUDGET is None, reason="FILECHECK_IMPORT_BUDGET isn't set")
+    def test_import_time_budget(self):
+        assert self.import_times()['bin.filecheck'] < int(IMPORT_TIME_BUDGET)
+
+
+@skipif_nodeps
+class TestCheckPipeline:
+
+    @fixture
+    def obj_path(self):
+        return 'tests/src_invalid/test.obj'
+
+    def test_short_circuit(self, obj_path):
+        file = File(obj_path, obj_path, None)
+        file.check()
+        assert file.is_dangerous
+        assert file.get_property('description_string') == [
+            'Mimetype does not match expected mimetype for this extension']
+
+    def test_full_diagnostics(self, obj_path):
+        file = File(obj_path, obj_path, None, full_diagnostics=True)
+        file.check()
+        assert file.get_property('description_string') == [
+            'Mimetype does not match expected mimetype for this extension',
+            'Extension does not match expected extensions for this mimetype']
+
+    def test_filename_check_always_runs(self, tmpdir):
+        file_path = tmpdir.join('test\u202Etxt.exe')
+        file_path.write('testing')
+        file = File(file_path.strpath, file_path.strpath, None)
+        file.check()
+        assert file.is_dangerous
+        assert '\u202E' not in file.dst_path
+
+    def test_contents_not_checked_when_dangerous(self, tmpdir):
+        file_path = tmpdir.join('test.exe')
+        file_path.write('testing')
+        file = File(file_path.strpath, file_path.strpath, None)
+        file.check()
+        assert file.is_dangerous
+        assert file.content_checked is False
+
 
 class TestFileHandling:
     def test_autorun(self):
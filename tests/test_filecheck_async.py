@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+
+import pytest
+
+# AsyncGroomer needs Python 3.6, these tests asyncio.run (3.7)
+if sys.version_info < (3, 7):
+    pytest.skip('Python 3.7+ is required', allow_module_level=True)
+
+import asyncio
+try:
+    from bin.filecheck import KittenGroomerFileCheck
+    from bin.filecheck_async import AsyncGroomer
+    NODEPS = False
+except ImportError:
+    NODEPS = True
+
+skipif_nodeps = pytest.mark.skipif(NODEPS,
+                                   reason="Dependencies aren't installed")
+
+
+@skipif_nodeps
+class TestAsyncGroomer:
+
+    def test_process_file(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = AsyncGroomer(KittenGroomerFileCheck(src_path, tmpdir.strpath))
+
+        async def process():
+            results = await groomer.process_file(os.path.join(src_path, 'blah.zip'))
+            await groomer.finish()
+            return results
+        results = asyncio.run(process())
+        assert sorted(result.path for result in results) == ['blah.zip', 'blah.zip/blah.conf', 'blah.zip/blah.txt']
+        assert os.path.exists(os.path.join(tmpdir.strpath, 'blah.zip', 'blah.txt'))
+
+    def test_iter_dir(self, tmpdir):
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        expected = KittenGroomerFileCheck(src_path, tmpdir.join('sync').strpath)
+        expected_paths = sorted(result.path for result in expected.iter_process())
+        expected.finish()
+        groomer = AsyncGroomer(KittenGroomerFileCheck(src_path, tmpdir.join('async').strpath),
+                               concurrency=2)
+
+        async def process():
+            paths = []
+            async for result in groomer.iter_dir():
+                paths.append(result.path)
+            await groomer.finish()
+            return paths
+        assert sorted(asyncio.run(process())) == expected_paths
+
+    def test_timeout(self, tmpdir):
+        class SlowGroomer(KittenGroomerFileCheck):
+            def process_archive(self, file, depth=0):
+                self._run_process('sleep 10')
+                super(SlowGroomer, self).process_archive(file, depth)
+
+        src_path = os.path.join(os.getcwd(), 'tests/src_invalid')
+        groomer = AsyncGroomer(SlowGroomer(src_path, tmpdir.strpath))
+
+        async def process():
+            with pytest.raises(asyncio.TimeoutError):
+                await groomer.process_file(os.path.join(src_path, 'blah.zip'), timeout=0.2)
+            start = time.monotonic()
+            while not len(groomer.groomer.results) and time.monotonic() - start < 5:
+                await asyncio.sleep(0.05)
+            await groomer.finish()
+            return time.monotonic() - start
+        assert asyncio.run(process()) < 5
+        assert groomer.groomer.results.largest('dangerous') == [('blah.zip', os.path.getsize(
+            os.path.join(src_path, 'blah.zip')))]
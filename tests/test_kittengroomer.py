@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
+import json
 import os
+import tarfile
+import zipfile
 
 import pytest
 
-from kittengroomer import FileBase, KittenGroomerBase
+from kittengroomer import FileBase, FileResult, KittenGroomerBase, DestinationWriter
+from kittengroomer import ArchiveWriter, MemoryWriter, as_buffer
+from kittengroomer import Progress, ProgressTracker, print_progress
 
 skip = pytest.mark.skip
 xfail = pytest.mark.xfail
@@ -213,6 +219,217 @@ class TestFileBase:
         generic_conf_file.safe_copy()
         # check that safe copy can handle weird file path inputs
 
+    def test_slots(self, generic_conf_file):
+        assert not hasattr(generic_conf_file, '__dict__')
+        props = generic_conf_file.get_all_props()
+        assert type(props['user_defined']) is dict and props['user_defined'] == {}
+        assert type(props['errors']) is dict and props['errors'] == {}
+        json.dumps(props)
+        generic_conf_file.set_property('thing', 1)
+        assert generic_conf_file.get_all_props()['user_defined'] == {'thing': 1}
+
+    def test_result(self, generic_conf_file):
+        generic_conf_file.set_property('thing', 1)
+        generic_conf_file.add_error(ValueError('oops'), 'info')
+        generic_conf_file.make_dangerous('Bad')
+        result = generic_conf_file.result()
+        assert isinstance(result, FileResult)
+        assert result.is_dangerous
+        assert not result.is_unknown
+        assert result.dst_path == generic_conf_file.dst_path
+        assert result.extension == '.conf'
+        assert result.get_property('description_string') == ['Bad']
+        assert result.get_property('thing') == 1
+        assert result.get_property('missing') is None
+        props = result.get_all_props()
+        assert list(props['errors'].values()) == ['info']
+        assert props == generic_conf_file.get_all_props()
+
+
+class TestDestinationWriter:
+
+    @fixture
+    def writer(self):
+        writer = DestinationWriter(max_queue_bytes=64)
+        yield writer
+        writer.close()
+
+    def test_copy_and_write(self, tmpdir, writer):
+        src = tmpdir.join('src.txt')
+        src.write('testing')
+        dst = tmpdir.join('a', 'b', 'dst.txt').strpath
+        writer.copy(src.strpath, dst)
+        writer.write(dst + '.metadata.txt', 'metadata')
+        writer.flush()
+        with open(dst) as f:
+            assert f.read() == 'testing'
+        with open(dst + '.metadata.txt') as f:
+            assert f.read() == 'metadata'
+        assert writer.errors == []
+
+    def test_source_removed_after_copy(self, tmpdir, writer):
+        src = tmpdir.join('src.txt')
+        src.write('testing')
+        dst = tmpdir.join('dst.txt').strpath
+        writer.copy(src.strpath, dst)
+        src.remove()
+        writer.close()
+        with open(dst) as f:
+            assert f.read() == 'testing'
+
+    def test_appends_keep_order(self, tmpdir, writer):
+        log_path = tmpdir.join('logs', 'log.txt').strpath
+        for i in range(100):
+            writer.append(log_path, '{}\n'.format(i))
+        writer.close()
+        with open(log_path) as f:
+            assert f.read().split() == [str(i) for i in range(100)]
+
+    def test_queue_is_bounded(self, tmpdir, writer):
+        for i in range(20):
+            writer.write(tmpdir.join('{}.txt'.format(i)).strpath, b'x' * 30)
+            assert writer.queued_bytes <= writer.max_queue_bytes
+        writer.flush()
+        assert writer.queued_bytes == 0
+
+    def test_big_file_copied_synchronously(self, tmpdir, writer):
+        src = tmpdir.join('big.bin')
+        src.write(b'x' * 1000, mode='wb')
+        dst = tmpdir.join('out', 'big.bin').strpath
+        writer.copy(src.strpath, dst)
+        assert os.path.getsize(dst) == 1000
+        assert writer.queued_bytes == 0
+
+    def test_errors_reported(self, tmpdir, writer):
+        errors = []
+        writer.copy(tmpdir.join('missing').strpath, tmpdir.join('dst').strpath,
+                    on_error=errors.append)
+        assert len(errors) == 1
+        writer.write(tmpdir.join('dst').strpath, b'', on_error=None)
+        writer.makedirs(tmpdir.join('dst').strpath)
+        writer.flush()
+        assert len(writer.errors) == 1
+        assert list(writer.failed) == [tmpdir.join('dst').strpath]
+
+    def test_failing_callback(self, tmpdir, writer):
+        def on_error(error):
+            raise RuntimeError('callback failed')
+        dst = tmpdir.mkdir('dst').strpath
+        writer.write(dst, b'data', on_error=on_error)
+        writer.write(tmpdir.join('other').strpath, b'data')
+        writer.flush()  # Doesn't hang: the writer thread survived the callback
+        assert isinstance(writer.failed[dst], IsADirectoryError)
+        assert [str(error) for error in writer.errors] == ['callback failed']
+        assert tmpdir.join('other').read() == 'data'
+
+    def test_file_base_uses_writer(self, tmpdir, writer):
+        src = tmpdir.join('test.txt')
+        src.write('testing')
+        dst = tmpdir.join('dst', 'test.txt').strpath
+        file = FileBase(src.strpath, dst, writer)
+        file.safe_copy()
+        file.write_dst_file(file.create_metadata_file('.metadata.txt'), 'metadata')
+        writer.flush()
+        assert os.path.exists(dst)
+        assert os.path.exists(dst + '.metadata.txt')
+
+
+class TestArchiveWriter:
+
+    @pytest.mark.parametrize('archive_format', ArchiveWriter.formats)
+    def test_archive(self, tmpdir, archive_format):
+        archive_path = tmpdir.join('dst', 'out.' + archive_format).strpath
+        writer = ArchiveWriter(archive_path, tmpdir.join('dst').strpath, archive_format,
+                               max_queue_bytes=64)
+        src = tmpdir.join('big.bin')
+        src.write(b'x' * 1000, mode='wb')
+        writer.copy(src.strpath, tmpdir.join('dst', 'a', 'big.bin').strpath)
+        writer.write(tmpdir.join('dst', 'a', 'test.txt').strpath, 'testing')
+        writer.duplicate(tmpdir.join('dst', 'a', 'test.txt').strpath,
+                         tmpdir.join('dst', 'b', 'test.txt').strpath)
+        writer.append(tmpdir.join('dst', 'log.txt').strpath, 'a')
+        writer.append(tmpdir.join('dst', 'log.txt').strpath, 'b')
+        writer.close()
+        assert writer.errors == []
+        assert os.listdir(tmpdir.join('dst').strpath) == ['out.' + archive_format]
+        if archive_format == 'zip':
+            with zipfile.ZipFile(archive_path) as archive:
+                files = {name: archive.read(name) for name in archive.namelist()}
+        else:
+            with tarfile.open(archive_path) as archive:
+                files = {name: archive.extractfile(name).read() for name in archive.getnames()}
+        assert files == {'a/big.bin': b'x' * 1000, 'a/test.txt': b'testing',
+                         'b/test.txt': b'testing', 'log.txt': b'ab'}
+
+    def test_unknown_format(self, tmpdir):
+        with pytest.raises(ValueError):
+            ArchiveWriter(tmpdir.join('out.rar').strpath, tmpdir.strpath, 'rar')
+
+
+class TestMemorySources:
+
+    def test_as_buffer(self, tmpdir):
+        assert as_buffer(b'abc') == b'abc'
+        assert as_buffer(io.BytesIO(b'abc')) == b'abc'
+        src = tmpdir.join('src.txt')
+        src.write('testing')
+        with open(src.strpath, 'rb') as f:
+            assert bytes(as_buffer(f)) == b'testing'
+
+    def test_file_from_bytes(self, tmpdir):
+        src = tmpdir.join('src.txt')
+        src.write('testing')
+        dst = tmpdir.join('dst', 'test.txt').strpath
+        writer = MemoryWriter()
+        file = FileBase('/nonexistent/test.txt', dst, writer, src_data=b'testing')
+        assert file.size == 7
+        assert file.mimetype == 'text/plain'
+        assert file.compute_hash() == FileBase(src.strpath, dst).compute_hash()
+        assert file.open_src().read() == b'testing'
+        file.safe_copy()
+        file.write_dst_file(file.create_metadata_file('.metadata.txt'), 'metadata')
+        assert writer.getvalue(dst) == b'testing'
+        assert writer.open(dst + '.metadata.txt').read() == b'metadata'
+        assert not os.path.exists(dst)
+
+
+class TestProgressTracker:
+
+    def test_rate_limited(self):
+        reports = []
+        tracker = ProgressTracker(reports.append, interval=60)
+        for i in range(100):
+            tracker.add_discovered(10)
+        for i in range(100):
+            tracker.start_file('file{}'.format(i))
+            tracker.file_done(10)
+        assert len(reports) == 1
+        tracker.finish()
+        assert len(reports) == 2
+        final = reports[-1]
+        assert final.finished
+        assert (final.files_processed, final.files_discovered) == (100, 100)
+        assert (final.bytes_processed, final.bytes_total) == (1000, 1000)
+        assert final.eta == 0
+
+    def test_eta(self):
+        reports = []
+        tracker = ProgressTracker(reports.append, interval=0)
+        tracker.add_discovered(100)
+        tracker.add_discovered(300)
+        tracker.start_file('first')
+        assert reports[-1].eta is None
+        assert reports[-1].current_file == 'first'
+        tracker.file_done(100)
+        progress = reports[-1]
+        assert progress.eta == pytest.approx(3 * progress.elapsed, rel=0.01)
+
+    def test_print_progress(self):
+        stream = io.StringIO()
+        progress = Progress(2, 1, 2 * 1024 * 1024, 1024 * 1024, 1.0, 1024 * 1024, 61.0, 'dir/file.pdf', False)
+        print_progress(progress, stream)
+        assert stream.getvalue().strip() == '1/2 files, 1.0/2.0 MB, 1.0 MB/s, ETA 01:01 - dir/file.pdf'
+
 
 class TestLogger:
 